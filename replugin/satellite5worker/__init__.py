@@ -17,10 +17,21 @@
 Satellite 5 worker.
 """
 
+import socket
+import sqlite3
+import threading
+import time
 import xmlrpclib
 
 from reworker.worker import Worker
 
+from replugin.satellite5worker.concurrency import run_concurrently
+from replugin.satellite5worker.engine import ConcurrentEngine
+from replugin.satellite5worker.idempotency import IdempotencyStore
+from replugin.satellite5worker.pkgcache import ChannelPackageCache
+from replugin.satellite5worker.repodata import RepodataTimeout, RepodataWatcher
+from replugin.satellite5worker.snapshots import PromotionSnapshotStore
+
 
 class Satellite5WorkerError(Exception):
     """
@@ -35,21 +46,90 @@ class Satellite5Worker(Worker):
     """
 
     #: allowed subcommands
-    subcommands = ('Promote', )
+    subcommands = ('Promote', 'PromoteDiff', 'RollbackPromotion', 'CloneChannel')
     dynamic = ['promote_from_label', 'promote_to_label']
+    rollback_dynamic = ['rollback_correlation_id']
+    clone_dynamic = ['clone_from_label', 'clone_to_label']
+    #: default number of package names listed in a PromoteDiff reply
+    diff_limit = 100
+    #: default number of packages removed per removePackages call
+    rollback_batch_size = 500
+    #: default number of channels cloned at the same time, on all Satellites
+    clone_concurrency = 4
+    #: default seconds to wait for repodata after a promotion
+    repodata_timeout = 1800
+    #: shared by all promotions so each channel is polled only once
+    repodata_watcher = RepodataWatcher()
     required_config_params = ['satellite_url', 'satellite_login', 'satellite_password']
+    #: how many Satellites a Promote must succeed on, unless configured
+    default_quorum = 'all'
+
+    #: created on first use by get_package_cache()
+    _package_cache = None
+    #: created on first use by get_snapshot_store()
+    _snapshot_store = None
+    #: created on first use by get_idempotency_store()
+    _idempotency_store = None
+    #: created on first use by get_engine()
+    _engine = None
 
     def verify_config(self, config):
-        """Verify that all required parameters are set in our config file"""
-        for key in self.required_config_params:
-            if key not in config:
-                # Missing key
+        """Verify that all required parameters are set in our config file
+
+Either one Satellite is configured at the top level of the config or
+a list of them is given as `satellites`, each with the same keys."""
+        endpoints = config.get('satellites', [config])
+        if not endpoints:
+            return False
+
+        for endpoint in endpoints:
+            for key in self.required_config_params:
+                if key not in endpoint:
+                    # Missing key
+                    return False
+
+            # If it doesn't start with http/s then it is not a valid endpoint
+            if not (endpoint['satellite_url'].startswith('http://') or
+                    endpoint['satellite_url'].startswith('https://')):
                 return False
 
-        # If it doesn't start with http/s then it is not a valid endpoint
-        # If it does, then this will return True
-        return (config['satellite_url'].startswith('http://') or
-                config['satellite_url'].startswith('https://'))
+        return True
+
+    def satellite_endpoints(self, config):
+        """Return the Satellites to talk to, primary first
+
+Each is a dict with the connection keys open_client() expects and a
+`name`, which defaults to the URL."""
+        endpoints = []
+        for endpoint in config.get('satellites', [config]):
+            for key in self.required_config_params:
+                if key not in endpoint:
+                    raise Satellite5WorkerError("Satellite config is missing %s" % key)
+            details = dict((k, endpoint[k]) for k in self.required_config_params)
+            details['name'] = endpoint.get('name', endpoint['satellite_url'])
+            endpoints.append(details)
+        if not endpoints:
+            raise Satellite5WorkerError("No Satellites configured")
+        return endpoints
+
+    def resolve_quorum(self, quorum, total):
+        """Turn a quorum setting into the number of Satellites needed
+
+`quorum` is 'all', 'majority' or a number between 1 and `total`."""
+        if total < 1:
+            raise Satellite5WorkerError("No Satellites to reach a quorum on")
+        if quorum == 'all':
+            return total
+        if quorum == 'majority':
+            return total // 2 + 1
+        try:
+            needed = int(quorum)
+        except (TypeError, ValueError):
+            needed = 0
+        if not 1 <= needed <= total:
+            raise Satellite5WorkerError("Invalid quorum for %s Satellites: %s" %
+                                        (total, quorum))
+        return needed
 
     def verify_subcommand(self, parameters):
         """Verify we were supplied with a valid subcommand"""
@@ -76,6 +156,24 @@ Promote parameters.
         # Got everything we need
         return True
 
+    def verify_RollbackPromotion_params(self, params):
+        """Verify the RollbackPromotion subcommand was provided all of the
+required parameters"""
+        for key in self.rollback_dynamic:
+            if key not in params:
+                raise Satellite5WorkerError("A required key was not provided: %s" % key)
+
+        return True
+
+    def verify_CloneChannel_params(self, params):
+        """Verify the CloneChannel subcommand was provided all of the
+required parameters"""
+        for key in self.clone_dynamic:
+            if key not in params:
+                raise Satellite5WorkerError("A required key was not provided: %s" % key)
+
+        return True
+
     def open_client(self, config):
         """Create an XMLRPC client to communicate to the Satellite server with"""
         try:
@@ -90,9 +188,135 @@ Promote parameters.
             else:
                 raise Satellite5WorkerError("Error connecting to the Satellite server: %s" %
                                             str(fault))
+        except (socket.error, xmlrpclib.ProtocolError), e:
+            raise Satellite5WorkerError("Could not reach the Satellite server: %s" %
+                                        str(e))
         else:
             return (client, key)
 
+    def config_section(self, name, allowed, required=()):
+        """Return the optional config section `name`, or an empty dict
+
+Raises Satellite5WorkerError if the section is not a mapping, lacks
+one of the `required` keys or has a key not in `allowed`."""
+        section = self._config.get(name, {})
+        if not isinstance(section, dict):
+            raise Satellite5WorkerError("The %s config section must be a mapping" % name)
+        for key in required:
+            if key not in section:
+                raise Satellite5WorkerError("The %s config section is missing %s" %
+                                            (name, key))
+        unknown = sorted(set(section).difference(allowed))
+        if unknown:
+            raise Satellite5WorkerError("Unknown key(s) in the %s config section: %s" %
+                                        (name, ", ".join(unknown)))
+        return section
+
+    def primary_url(self):
+        """Return the URL of the primary Satellite"""
+        return self.satellite_endpoints(self._config)[0]['satellite_url']
+
+    def get_package_cache(self):
+        """Return the local cache of channel contents
+
+The cache is configured by the optional `package_cache` config
+section and is kept in memory unless a `path` is given there. It only
+holds channels of the primary Satellite; package IDs differ between
+Satellites."""
+        if self._package_cache is None:
+            section = self.config_section(
+                'package_cache',
+                ('path', 'max_channels', 'max_age', 'refresh_interval'))
+            try:
+                self._package_cache = ChannelPackageCache(**section)
+            except (OSError, sqlite3.Error), e:
+                raise Satellite5WorkerError("Could not open the package cache: %s" % e)
+        return self._package_cache
+
+    def get_snapshot_store(self):
+        """Return the store of promotion snapshots
+
+Returns None unless the `snapshots` config section gives a `path` to
+keep them in."""
+        if self._snapshot_store is None and 'snapshots' in self._config:
+            section = self.config_section('snapshots', ('path', ), ('path', ))
+            try:
+                self._snapshot_store = PromotionSnapshotStore(section['path'])
+            except (OSError, sqlite3.Error), e:
+                raise Satellite5WorkerError("Could not open the snapshot store: %s" % e)
+        return self._snapshot_store
+
+    def get_idempotency_store(self):
+        """Return the store of completed promotion results
+
+Returns None unless the `idempotency` config section gives a `path`
+to keep them in."""
+        if self._idempotency_store is None and 'idempotency' in self._config:
+            section = self.config_section(
+                'idempotency', ('path', 'ttl', 'max_entries'), ('path', ))
+            try:
+                self._idempotency_store = IdempotencyStore(**section)
+            except (OSError, sqlite3.Error), e:
+                raise Satellite5WorkerError("Could not open the idempotency store: %s" % e)
+        return self._idempotency_store
+
+    def idempotency_key(self, body, corr_id):
+        """Return the key a Promote request's result is recorded under
+
+Returns None for other requests, which are never short-circuited."""
+        try:
+            if body['parameters']['subcommand'] != 'Promote':
+                return None
+            return "%s:%s:%s" % (corr_id,
+                                 body['dynamic']['promote_from_label'],
+                                 body['dynamic']['promote_to_label'])
+        except (KeyError, TypeError):
+            return None
+
+    def get_engine(self, channel):
+        """Return the engine requests are handed to, or None to handle
+them on the consumer thread
+
+The engine is enabled by the optional `engine` config section, which
+may set `max_inflight`, `stack_size`, `poll_interval` and
+`aging_interval`. `channel` is the bus channel requests arrive on."""
+        if self._engine is None and 'engine' in self._config:
+            section = self.config_section(
+                'engine',
+                ('max_inflight', 'stack_size', 'poll_interval', 'aging_interval'))
+            # Set up the shared stores now, before several threads race
+            # to do it on first use
+            self.get_package_cache()
+            self.get_snapshot_store()
+            self.get_idempotency_store()
+            self._engine = ConcurrentEngine(
+                channel.connection, self.app_logger, **section)
+        return self._engine
+
+    def send(self, *args, **kwargs):
+        """Send a message on the bus, from any thread"""
+        engine = self._engine
+        if engine is not None and not engine.in_loop_thread():
+            return engine.call_in_loop(
+                super(Satellite5Worker, self).send, *args, **kwargs)
+        return super(Satellite5Worker, self).send(*args, **kwargs)
+
+    def notify(self, *args, **kwargs):
+        """Send a notification on the bus, from any thread"""
+        engine = self._engine
+        if engine is not None and not engine.in_loop_thread():
+            return engine.call_in_loop(
+                super(Satellite5Worker, self).notify, *args, **kwargs)
+        return super(Satellite5Worker, self).notify(*args, **kwargs)
+
+    def get_channel_package_ids(self, client, key, label):
+        """Return a sorted array of the package IDs in channel `label`"""
+        try:
+            return self.get_package_cache().package_ids(client, key, label)
+        except xmlrpclib.Fault, fault:
+            raise Satellite5WorkerError("Could not list packages in %s: %s" %
+                                        (label, str(fault)))
+
     def verify_Promote_channels(self, client, key, source, destination):
         """Make sure the source and destination channels both exist"""
         not_found = []
@@ -112,17 +336,236 @@ Promote parameters.
         else:
             return True
 
-    def do_Promote_channel_merge(self, client, key, source, destination):
+    def do_Promote_channel_merge(self, client, key, source, destination,
+                                 corr_id=None, server=None):
         """Merge the contents of `source` channel into `destination` channel
 
+If snapshots are enabled and `corr_id` is given, the IDs of the
+packages added are recorded so RollbackPromotion can remove them.
+`server` is the URL of the Satellite `client` talks to and defaults
+to the primary one.
+
 Returns the count of the number of packages promoted"""
         try:
             result = client.channel.software.mergePackages(key, source, destination)
         except xmlrpclib.Fault, fault:
             raise Satellite5WorkerError("Could not promote: %s" % str(fault))
         else:
+            if server is None or server == self.primary_url():
+                self.get_package_cache().add_packages(destination, result)
+            store = self.get_snapshot_store()
+            if store is not None and corr_id is not None:
+                store.record(corr_id, server or self.primary_url(),
+                             source, destination, [p['id'] for p in result])
             return len(result)
 
+    def do_RollbackPromotion(self, client, key, promotion_id, batch_size,
+                             output, server=None):
+        """Remove the packages promotion `promotion_id` added from their
+destination channels, `batch_size` packages per call
+
+Every channel pair promoted under `promotion_id` is rolled back in its
+own destination, the most recent promotion first. Progress is saved
+after every batch, so running the rollback again after a failure
+continues with the packages that are left.
+
+Returns the number of packages removed and the destination channels"""
+        store = self.get_snapshot_store()
+        if store is None:
+            raise Satellite5WorkerError("Promotion snapshots are not enabled")
+
+        server = server or self.primary_url()
+        snapshots = store.find(promotion_id, server)
+        if not snapshots:
+            raise Satellite5WorkerError("No snapshot recorded for promotion %s" %
+                                        promotion_id)
+
+        removed = 0
+        destinations = []
+        for snapshot in snapshots:
+            source = snapshot['source']
+            destination = snapshot['destination']
+            ids = snapshot['ids']
+            done = snapshot['removed']
+            while done < len(ids):
+                batch = ids[done:done + batch_size].tolist()
+                try:
+                    client.channel.software.removePackages(key, destination, batch)
+                except xmlrpclib.Fault, fault:
+                    # Some of the batch may have been removed anyway
+                    if server == self.primary_url():
+                        self.get_package_cache().invalidate(destination)
+                    raise Satellite5WorkerError(
+                        "Could not remove packages from %s (%s of %s removed): %s" %
+                        (destination, done, len(ids), str(fault)))
+                done += len(batch)
+                store.mark_removed(promotion_id, server, source, destination, done)
+                if server == self.primary_url():
+                    self.get_package_cache().remove_packages(destination, batch)
+                output.info("Rolled back %s of %s packages in '%s'" %
+                            (done, len(ids), destination))
+            removed += done - snapshot['removed']
+            destinations.append(destination)
+        return (removed, destinations)
+
+    def get_repodata_build(self, client, key, channel_id):
+        """Return the time the repodata of a channel was last built"""
+        try:
+            return client.channel.software.getChannelLastBuildById(key, channel_id)
+        except xmlrpclib.Fault, fault:
+            raise Satellite5WorkerError("Could not get repodata build time: %s" %
+                                        str(fault))
+
+    def do_Promote_repodata_baseline(self, client, key, label):
+        """Look up the ID of channel `label` and its last repodata build
+
+Returns both as a tuple, for passing to do_Promote_wait_for_repodata"""
+        try:
+            channel_id = client.channel.software.getDetails(key, label)['id']
+        except xmlrpclib.Fault, fault:
+            raise Satellite5WorkerError("Could not locate channel %s: %s" %
+                                        (label, str(fault)))
+        return (channel_id, self.get_repodata_build(client, key, channel_id))
+
+    def do_Promote_wait_for_repodata(self, client, key, label, baseline,
+                                     timeout, server=None):
+        """Wait until the repodata of channel `label` has been rebuilt
+
+`baseline` is what do_Promote_repodata_baseline returned before the
+merge. Returns the number of seconds waited."""
+        (channel_id, build) = baseline
+        try:
+            return self.repodata_watcher.wait(
+                (server or self.primary_url(), label), build,
+                lambda: self.get_repodata_build(client, key, channel_id),
+                timeout)
+        except RepodataTimeout:
+            raise Satellite5WorkerError(
+                "Repodata for %s was not rebuilt within %s seconds" %
+                (label, timeout))
+
+    def clone_label(self, label, source, destination):
+        """Return the label the clone of child channel `label` gets when
+its parent `source` is cloned as `destination`"""
+        if source in label:
+            return label.replace(source, destination, 1)
+        return "%s-%s" % (destination, label)
+
+    def do_CloneChannel_clone(self, client, key, source, label, parent,
+                              original_state):
+        """Clone channel `source` as `label`, under `parent` if given
+
+Returns a dict describing the new channel"""
+        details = {
+            'name': label,
+            'label': label,
+            'summary': 'Clone of %s' % source,
+        }
+        if parent:
+            details['parent_label'] = parent
+        start = time.time()
+        try:
+            channel_id = client.channel.software.clone(
+                key, source, details, original_state)
+        except xmlrpclib.Fault, fault:
+            raise Satellite5WorkerError("Could not clone %s as %s: %s" %
+                                        (source, label, str(fault)))
+        return {
+            'label': label,
+            'source': source,
+            'id': channel_id,
+            'seconds': time.time() - start,
+        }
+
+    def do_CloneChannel_list(self, client, key):
+        """Return the channels on a Satellite by label"""
+        try:
+            return dict((c['label'], c) for c in
+                        client.channel.listAllChannels(key))
+        except xmlrpclib.Fault, fault:
+            raise Satellite5WorkerError("Could not list channels: %s" % str(fault))
+
+    def do_CloneChannel(self, endpoint, client, key, source, destination,
+                        children, original_state, limit, output, slots=None):
+        """Clone channel `source` as `destination` and, if `children` is
+set, each of its child channels under the new one
+
+Child channels are cloned at most `limit` at a time, each over a
+connection of its own. `slots`, a semaphore shared with the clones
+running on other Satellites, caps them across all of those instead.
+Channels whose clone already exists, say from an earlier attempt that
+failed part way, are not cloned again. Returns a dict per channel
+giving its label, the channel it was cloned from, how many seconds the
+clone took and how many packages it holds; channels which already
+existed are marked `existing`."""
+        if slots is None:
+            slots = threading.BoundedSemaphore(limit)
+        try:
+            details = client.channel.software.getDetails(key, source)
+            if children:
+                child_labels = [c['label'] for c in
+                                client.channel.software.listChildren(key, source)]
+            else:
+                child_labels = []
+        except xmlrpclib.Fault, fault:
+            raise Satellite5WorkerError("Could not locate channel %s: %s" %
+                                        (source, str(fault)))
+        existing = self.do_CloneChannel_list(client, key)
+
+        def clone(client, channel, label, parent):
+            if label in existing:
+                return {
+                    'label': label,
+                    'source': channel,
+                    'id': existing[label].get('id'),
+                    'seconds': 0,
+                    'existing': True,
+                }
+            with slots:
+                return self.do_CloneChannel_clone(
+                    client, key, channel, label, parent, original_state)
+
+        def report(channel, result):
+            if result.get('existing'):
+                output.info("'%s' already exists on %s, not cloning '%s' again" %
+                            (result['label'], endpoint['name'], channel))
+            else:
+                output.info("Cloned '%s' as '%s' on %s" %
+                            (channel, result['label'], endpoint['name']))
+
+        cloned = [clone(client, source, destination,
+                        details.get('parent_channel_label'))]
+        report(source, cloned[0])
+
+        def clone_child(child):
+            # xmlrpclib proxies are not safe to share between threads
+            return clone(xmlrpclib.Server(endpoint['satellite_url']), child,
+                         self.clone_label(child, source, destination),
+                         destination)
+
+        results = run_concurrently(
+            [(lambda c=child: clone_child(c)) for child in child_labels], limit)
+
+        failed = []
+        for child, (result, error) in zip(child_labels, results):
+            if error is None:
+                cloned.append(result)
+                report(child, result)
+            else:
+                output.error(str(error))
+                failed.append(child)
+        if failed:
+            raise Satellite5WorkerError(
+                "Could not clone child channel(s) of %s: %s (in place: %s; "
+                "run again to clone the rest)" %
+                (source, ", ".join(failed),
+                 ", ".join(c['label'] for c in cloned)))
+
+        counts = self.do_CloneChannel_list(client, key)
+        for channel in cloned:
+            channel['packages'] = counts.get(channel['label'], {}).get('packages')
+        return cloned
+
     def close_client(self, client, key):
         """Logout and destroy the XMLRPC client"""
         try:
@@ -132,18 +575,348 @@ Returns the count of the number of packages promoted"""
         else:
             return True
 
+    def do_PromoteDiff(self, client, key, source, destination, limit):
+        """Work out which packages promoting `source` into `destination`
+would add, without changing either channel
+
+Returns a dict with the number of packages and, at most `limit` of,
+their NEVRAs"""
+        missing = sorted(set(
+            self.get_channel_package_ids(client, key, source)).difference(
+                self.get_channel_package_ids(client, key, destination)))
+        shown = missing[:limit]
+        names = self.get_package_cache().nevras(source, shown)
+        return {
+            'count': len(missing),
+            'packages': sorted(names.get(i, str(i)) for i in shown),
+            'truncated': len(shown) < len(missing),
+        }
+
+    def do_Promote_on_satellite(self, endpoint, source_channel, dest_channel,
+                                corr_id, repodata_timeout, output):
+        """Run a promotion on the Satellite described by `endpoint`
+
+Waits for the destination repodata unless `repodata_timeout` is None.
+Returns the reply data for this Satellite."""
+        server = endpoint['satellite_url']
+
+        # Open connection to remote server and log into it
+        (client, key) = self.open_client(endpoint)
+
+        # Verify source and target channels exist
+        self.verify_Promote_channels(client, key, source_channel, dest_channel)
+
+        if repodata_timeout is not None:
+            baseline = self.do_Promote_repodata_baseline(client, key, dest_channel)
+
+        # Merge contents of source into target
+        result = self.do_Promote_channel_merge(client, key, source_channel, dest_channel,
+                                               corr_id=corr_id, server=server)
+        data = {'count': result}
+
+        # Nothing new means no new repodata either
+        if repodata_timeout is not None and result:
+            output.info("Waiting for the repodata of '%s' on %s to be rebuilt" %
+                        (dest_channel, endpoint['name']))
+            data['repodata_seconds'] = self.do_Promote_wait_for_repodata(
+                client, key, dest_channel, baseline, repodata_timeout,
+                server=server)
+            self.app_logger.info("Repodata for '%s' on %s available after %.1f seconds" %
+                                 (dest_channel, endpoint['name'],
+                                  data['repodata_seconds']))
+        elif repodata_timeout is not None:
+            data['repodata_seconds'] = 0
+
+        # Logout
+        self.close_client(client, key)
+
+        self.app_logger.info("Promoted %s packages from '%s' into '%s' on %s" %
+                             (result, source_channel, dest_channel,
+                              endpoint['name']))
+        return data
+
+    def process_Promote(self, body, corr_id, output):
+        """Merge the source channel into the destination channel on every
+configured Satellite
+
+Returns the reply data and a short summary of what was done"""
+        # Verify subcmd parameters
+        self.verify_Promote_params(body['dynamic'])
+        source_channel = body['dynamic']['promote_from_label']
+        dest_channel = body['dynamic']['promote_to_label']
+
+        repodata_timeout = None
+        if body['parameters'].get('wait_for_repodata', False):
+            try:
+                repodata_timeout = float(body['parameters'].get(
+                    'repodata_timeout',
+                    self._config.get('repodata_timeout', self.repodata_timeout)))
+            except (TypeError, ValueError):
+                raise Satellite5WorkerError("repodata_timeout must be a number")
+
+        endpoints = self.satellite_endpoints(self._config)
+        if len(endpoints) == 1:
+            data = self.do_Promote_on_satellite(
+                endpoints[0], source_channel, dest_channel, corr_id,
+                repodata_timeout, output)
+            # Output to the general logger (taboot tailer perhaps)
+            output.info('Satellite 5 worker finished promoting channel '
+                        'contents (count: %s)' % data['count'])
+            return (data, '%s packages promoted' % data['count'])
+
+        needed = self.resolve_quorum(
+            body['parameters'].get(
+                'quorum', self._config.get('satellite_quorum', self.default_quorum)),
+            len(endpoints))
+
+        # Every Satellite gets its own session, all at the same time
+        results = run_concurrently([
+            (lambda e=endpoint: self.do_Promote_on_satellite(
+                e, source_channel, dest_channel, corr_id, repodata_timeout,
+                output))
+            for endpoint in endpoints])
+
+        data = {'count': 0, 'servers': {}, 'failed': []}
+        for endpoint, (result, error) in zip(endpoints, results):
+            if error is None:
+                data['servers'][endpoint['name']] = result
+                data['count'] += result['count']
+            else:
+                self.app_logger.error("Promotion on %s failed: %s" %
+                                      (endpoint['name'], error))
+                output.error("Promotion on %s failed: %s" %
+                             (endpoint['name'], error))
+                data['servers'][endpoint['name']] = {'error': str(error)}
+                data['failed'].append(endpoint['name'])
+
+        succeeded = len(endpoints) - len(data['failed'])
+        if succeeded < needed:
+            raise Satellite5WorkerError(
+                "Promotion succeeded on %s of %s Satellites, %s needed. Failed: %s" %
+                (succeeded, len(endpoints), needed, ", ".join(data['failed'])))
+
+        output.info('Satellite 5 worker finished promoting channel '
+                    'contents on %s of %s Satellites (count: %s)' %
+                    (succeeded, len(endpoints), data['count']))
+        return (data, '%s packages promoted on %s of %s Satellites' %
+                (data['count'], succeeded, len(endpoints)))
+
+    def process_PromoteDiff(self, body, corr_id, output):
+        """Report what a Promote with the same parameters would change
+
+Returns the reply data and a short summary of the difference"""
+        self.verify_Promote_params(body['dynamic'])
+        try:
+            limit = int(body['parameters'].get('diff_limit', self.diff_limit))
+        except (TypeError, ValueError):
+            raise Satellite5WorkerError("diff_limit must be an integer")
+
+        # Compare on the primary Satellite only
+        (client, key) = self.open_client(self.satellite_endpoints(self._config)[0])
+
+        source_channel = body['dynamic']['promote_from_label']
+        dest_channel = body['dynamic']['promote_to_label']
+        self.verify_Promote_channels(client, key, source_channel, dest_channel)
+
+        result = self.do_PromoteDiff(client, key, source_channel, dest_channel,
+                                     max(limit, 0))
+
+        self.close_client(client, key)
+
+        self.app_logger.info("%s packages in '%s' are not in '%s'" %
+                             (result['count'], source_channel, dest_channel))
+        output.info('Satellite 5 worker finished comparing channel '
+                    'contents (count: %s)' % result['count'])
+        return (result, '%s packages would be promoted' % result['count'])
+
+    def process_RollbackPromotion(self, body, corr_id, output):
+        """Undo an earlier promotion recorded in the snapshot store
+
+Returns the reply data and a short summary of what was removed"""
+        self.verify_RollbackPromotion_params(body['dynamic'])
+        promotion_id = str(body['dynamic']['rollback_correlation_id'])
+        try:
+            batch_size = int(body['parameters'].get(
+                'rollback_batch_size', self.rollback_batch_size))
+        except (TypeError, ValueError):
+            raise Satellite5WorkerError("rollback_batch_size must be an integer")
+        if batch_size < 1:
+            raise Satellite5WorkerError("rollback_batch_size must be positive")
+
+        store = self.get_snapshot_store()
+        if store is None:
+            raise Satellite5WorkerError("Promotion snapshots are not enabled")
+
+        # Roll back wherever the promotion left a snapshot
+        endpoints = [e for e in self.satellite_endpoints(self._config)
+                     if store.find(promotion_id, e['satellite_url'])]
+        if not endpoints:
+            raise Satellite5WorkerError("No snapshot recorded for promotion %s" %
+                                        promotion_id)
+
+        def rollback(endpoint):
+            (client, key) = self.open_client(endpoint)
+            (result, dest_channels) = self.do_RollbackPromotion(
+                client, key, promotion_id, batch_size, output,
+                server=endpoint['satellite_url'])
+            self.close_client(client, key)
+            self.app_logger.info("Rolled back promotion %s: removed %s packages from '%s' on %s" %
+                                 (promotion_id, result, "', '".join(dest_channels),
+                                  endpoint['name']))
+            return result
+
+        results = run_concurrently([
+            (lambda e=endpoint: rollback(e)) for endpoint in endpoints])
+
+        failed = []
+        for endpoint, (result, error) in zip(endpoints, results):
+            if error is not None:
+                output.error("Rollback on %s failed: %s" % (endpoint['name'], error))
+                failed.append("%s (%s)" % (endpoint['name'], error))
+        if failed:
+            raise Satellite5WorkerError("Rollback of promotion %s failed on: %s" %
+                                        (promotion_id, ", ".join(failed)))
+
+        result = sum(r for (r, e) in results)
+        output.info('Satellite 5 worker finished rolling back promotion '
+                    '%s (count: %s)' % (promotion_id, result))
+        return ({'count': result}, '%s packages rolled back' % result)
+
+    def process_CloneChannel(self, body, corr_id, output):
+        """Clone a channel, and optionally its children, on every
+configured Satellite
+
+Returns the reply data and a short summary of what was cloned"""
+        self.verify_CloneChannel_params(body['dynamic'])
+        source_channel = body['dynamic']['clone_from_label']
+        dest_channel = body['dynamic']['clone_to_label']
+        children = bool(body['parameters'].get('clone_children', False))
+        original_state = bool(body['parameters'].get('clone_original_state', False))
+        try:
+            limit = int(body['parameters'].get(
+                'clone_concurrency',
+                self._config.get('clone_concurrency', self.clone_concurrency)))
+        except (TypeError, ValueError):
+            raise Satellite5WorkerError("clone_concurrency must be an integer")
+        if limit < 1:
+            raise Satellite5WorkerError("clone_concurrency must be positive")
+
+        # clone_concurrency caps the clones in flight on all of the
+        # Satellites together
+        slots = threading.BoundedSemaphore(limit)
+
+        def clone(endpoint):
+            (client, key) = self.open_client(endpoint)
+            cloned = self.do_CloneChannel(
+                endpoint, client, key, source_channel, dest_channel, children,
+                original_state, limit, output, slots=slots)
+            self.close_client(client, key)
+            self.app_logger.info("Cloned %s channel(s) from '%s' as '%s' on %s" %
+                                 (len(cloned), source_channel, dest_channel,
+                                  endpoint['name']))
+            return cloned
+
+        endpoints = self.satellite_endpoints(self._config)
+        if len(endpoints) == 1:
+            cloned = clone(endpoints[0])
+            data = {'count': len(cloned), 'channels': cloned}
+        else:
+            results = run_concurrently([
+                (lambda e=endpoint: clone(e)) for endpoint in endpoints])
+            data = {'count': 0, 'servers': {}}
+            failed = []
+            for endpoint, (cloned, error) in zip(endpoints, results):
+                if error is None:
+                    data['servers'][endpoint['name']] = cloned
+                    data['count'] += len(cloned)
+                else:
+                    output.error("Clone on %s failed: %s" % (endpoint['name'], error))
+                    failed.append("%s (%s)" % (endpoint['name'], error))
+            if failed:
+                raise Satellite5WorkerError("Clone of %s failed on: %s" %
+                                            (source_channel, ", ".join(failed)))
+
+        output.info('Satellite 5 worker finished cloning channels '
+                    '(count: %s)' % data['count'])
+        return (data, '%s channels cloned' % data['count'])
+
     def process(self, channel, basic_deliver, properties, body, output):
         """Processes Sat5 requests from the bus.
 
-        Verify we have eveything we need to do the needful. Then setup
-        the xmlrpc client. Then start doing the needful.
-
-        This assumes we still have just one subcommand, promote
+        Verify we have eveything we need to do the needful. Then hand
+        off to the process_<subcommand> method which sets up the xmlrpc
+        client and does the needful. With the engine enabled that all
+        happens on one of its threads, after this method has returned.
         """
         # Ack the original message
         self.ack(basic_deliver)
         corr_id = str(properties.correlation_id)
 
+        try:
+            store = self.get_idempotency_store()
+            engine = self.get_engine(channel)
+        except Satellite5WorkerError, s5we:
+            self.report_failure(properties, corr_id, s5we, output)
+            return
+
+        # A redelivered request we already completed just gets the
+        # same answer again
+        request_key = self.idempotency_key(body, corr_id)
+        if store is not None and request_key is not None:
+            recorded = store.get(request_key)
+            if recorded is not None:
+                self.app_logger.info("Request %s was already completed, "
+                                     "replying with the recorded result" %
+                                     request_key)
+                self.send(
+                    properties.reply_to,
+                    corr_id,
+                    recorded,
+                    exchange=''
+                )
+                output.info("Request already completed, not promoting again")
+                return
+
+        if engine is None:
+            self.handle_request(properties, body, output)
+        else:
+            (priority, group) = self.request_priority(body, corr_id)
+            engine.submit(self.handle_request, (properties, body, output),
+                          priority, group)
+
+    def request_priority(self, body, corr_id):
+        """Return the priority of a request and the group it is scheduled
+fairly within
+
+Both come from the `priority` (an integer, higher runs sooner, default
+0) and `pipeline` parameters; requests without a pipeline are grouped
+by correlation id."""
+        parameters = body.get('parameters', {})
+        try:
+            priority = int(parameters.get('priority', 0))
+        except (TypeError, ValueError):
+            self.app_logger.warn("Ignoring invalid priority for %s: %s" %
+                                 (corr_id, parameters.get('priority')))
+            priority = 0
+        return (priority, parameters.get('pipeline', corr_id))
+
+    def handle_request(self, properties, body, output, queue_wait=None):
+        """Run a request which process() accepted and reply with the result
+
+`queue_wait` is how long the request was queued by the engine, if it
+was; it is logged and added to the reply data."""
+        corr_id = str(properties.correlation_id)
+        if queue_wait is not None:
+            (priority, group) = self.request_priority(body, corr_id)
+            (count, average, longest) = self._engine.wait_stats(priority)
+            self.app_logger.info(
+                "Request %s waited %.2f seconds at priority %s (priority %s "
+                "average %.2f, longest %.2f over %s requests)" %
+                (corr_id, queue_wait, priority, priority, average, longest,
+                 count))
+        store = self.get_idempotency_store()
+        request_key = self.idempotency_key(body, corr_id)
+
         self.app_logger.info("New promotion starting now")
         # Tell the FSM that we're starting now
         self.send(
@@ -167,61 +940,57 @@ Returns the count of the number of packages promoted"""
 
             # Verify valid subcommand
             self.verify_subcommand(body['parameters'])
+            subcommand = body['parameters']['subcommand']
 
-            # Verify subcmd parameters
-            self.verify_Promote_params(body['dynamic'])
-
-            # Open connection to remote server and log into it
-            (client, key) = self.open_client(self._config)
-
-            # Verify source and target channels exist
-            source_channel = body['dynamic']['promote_from_label']
-            dest_channel = body['dynamic']['promote_to_label']
-            self.verify_Promote_channels(client, key, source_channel, dest_channel)
+            (data, summary) = getattr(self, 'process_%s' % subcommand)(
+                body, corr_id, output)
 
-            # Merge contents of source into target
-            result = self.do_Promote_channel_merge(client, key, source_channel, dest_channel)
-
-            # Logout
-            self.close_client(client, key)
-
-            self.app_logger.info("Promoted %s packages from '%s' into '%s'" %
-                                 (result, source_channel, dest_channel))
+            if queue_wait is not None:
+                data['queue_wait'] = queue_wait
+                data['priority'] = priority
+            result = {'status': 'completed', 'data': data}
+            if store is not None and request_key is not None:
+                store.record(request_key, result)
             self.send(
                 properties.reply_to,
                 corr_id,
-                {'status': 'completed', 'data': {'count': result}},
+                result,
                 exchange=''
             )
             # Notify over various other comm channels about the result
             self.notify(
                 'Satellite 5 Worker completed',
-                '%s packages promoted' % result,
+                summary,
                 'completed',
                 corr_id)
 
-            # Output to the general logger (taboot tailer perhaps)
-            output.info('Satellite 5 worker finished promoting channel '
-                        'contents (count: %s)' % result)
-
         except Satellite5WorkerError, s5we:
-            # If an error happens send a failure and log it to stdout
-            self.app_logger.error('Failure: %s' % s5we)
-            # Send a message to the FSM indicating a failure event took place
-            self.send(
-                properties.reply_to,
-                corr_id,
-                {'status': 'failed'},
-                exchange=''
-            )
-            # Notify over various other comm channels about the event
-            self.notify(
-                'Satellite 5 Worker Failed',
-                str(s5we),
-                'failed',
-                corr_id)
-            # Output to the general logger (taboot tailer perhaps)
-            output.error(str(s5we))
+            self.report_failure(properties, corr_id, s5we, output)
+        except Exception, e:
+            # The FSM was told the request started, so it must hear
+            # about it failing as well
+            self.report_failure(properties, corr_id, Satellite5WorkerError(
+                "Unexpected error: %s: %s" % (e.__class__.__name__, e)), output)
+
+    def report_failure(self, properties, corr_id, error, output):
+        """Tell the FSM and everyone listening that a request failed"""
+        # If an error happens send a failure and log it to stdout
+        self.app_logger.error('Failure: %s' % error)
+        # Send a message to the FSM indicating a failure event took place
+        self.send(
+            properties.reply_to,
+            corr_id,
+            {'status': 'failed'},
+            exchange=''
+        )
+        # Notify over various other comm channels about the event
+        self.notify(
+            'Satellite 5 Worker Failed',
+            str(error),
+            'failed',
+            corr_id)
+        # Output to the general logger (taboot tailer perhaps)
+        output.error(str(error))
 
 
 def main():  # pragma: no cover
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Running independent Satellite calls side by side.
+"""
+
+import threading
+
+
+def run_concurrently(tasks, limit=None):
+    """Call each of `tasks` in a thread of its own, at most `limit` at once
+
+Returns a (result, exception) tuple for every task, in the same order
+as `tasks`. Exactly one of the two is None."""
+    results = [None] * len(tasks)
+
+    def run(index, task):
+        try:
+            results[index] = (task(), None)
+        except Exception, e:
+            results[index] = (None, e)
+
+    if len(tasks) == 1:
+        run(0, tasks[0])
+        return results
+
+    slots = threading.BoundedSemaphore(limit or len(tasks) or 1)
+
+    def run_in_slot(index, task):
+        try:
+            run(index, task)
+        finally:
+            slots.release()
+
+    threads = []
+    for index, task in enumerate(tasks):
+        slots.acquire()
+        thread = threading.Thread(target=run_in_slot, args=(index, task))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Engine for keeping many requests in flight at once.
+"""
+
+import Queue
+import threading
+
+from replugin.satellite5worker.scheduler import PriorityScheduler
+
+
+class ConcurrentEngine(object):
+    """
+    Runs requests away from the thread consuming the bus.
+
+    Submitted requests are queued by priority (see PriorityScheduler)
+    and picked up by up to `max_inflight` runner threads, started as
+    they are needed with a small stack since they spend their time
+    waiting on the Satellite. pika connections
+    are not thread safe, so anything a runner wants done on the bus is
+    queued as well and carried out by the ioloop of `connection`, which
+    checks for it every `poll_interval` seconds.
+    """
+
+    def __init__(self, connection, logger, max_inflight=50,
+                 stack_size=256 * 1024, poll_interval=0.05, aging_interval=60):
+        self.max_inflight = max_inflight
+        self.stack_size = stack_size
+        self.poll_interval = poll_interval
+        self._connection = connection
+        self._logger = logger
+        self._loop_thread = threading.current_thread()
+        self._pending = PriorityScheduler(aging_interval)
+        self._outbox = Queue.Queue()
+        self._cond = threading.Condition()
+        self._runners = 0
+        self._idle = 0
+        self._connection.add_timeout(self.poll_interval, self._drain)
+
+    def in_loop_thread(self):
+        """Return True when called from the ioloop thread"""
+        return threading.current_thread() is self._loop_thread
+
+    def call_in_loop(self, func, *args, **kwargs):
+        """Call `func` on the ioloop thread, right away if already there"""
+        if self.in_loop_thread():
+            return func(*args, **kwargs)
+        self._outbox.put((func, args, kwargs))
+
+    def submit(self, func, args=(), priority=0, group=None):
+        """Queue `func(*args)` to be run by a runner thread
+
+`func` also gets the seconds the request waited as `queue_wait`."""
+        with self._cond:
+            self._pending.put((func, args), priority, group)
+            self._cond.notify()
+            # Waiting runners take pending requests as they wake up, so
+            # only start another one if there are more requests than them
+            if (len(self._pending) <= self._idle or
+                    self._runners >= self.max_inflight):
+                return
+            self._runners += 1
+        previous = threading.stack_size(self.stack_size)
+        try:
+            runner = threading.Thread(target=self._run)
+            runner.daemon = True
+            runner.start()
+        finally:
+            threading.stack_size(previous)
+
+    def _run(self):
+        """Body of the runner threads"""
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                ((func, args), priority, waited) = self._pending.pop()
+            try:
+                func(*args, queue_wait=waited)
+            except Exception, e:
+                self._logger.error("Unhandled error in request: %s" % e)
+
+    def wait_stats(self, priority):
+        """Return the number of requests run at `priority`, their average
+and their longest wait in the queue in seconds"""
+        with self._cond:
+            return self._pending.wait_stats(priority)
+
+    def _drain(self):
+        """Carry out queued bus calls, then check again later"""
+        try:
+            while True:
+                (func, args, kwargs) = self._outbox.get_nowait()
+                try:
+                    func(*args, **kwargs)
+                except Exception, e:
+                    self._logger.error("Could not talk to the bus: %s" % e)
+        except Queue.Empty:
+            pass
+        self._connection.add_timeout(self.poll_interval, self._drain)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Results of completed requests, so redelivered messages are not re-run.
+"""
+
+import json
+import time
+
+from replugin.satellite5worker.store import SQLiteStore
+
+
+class IdempotencyStore(SQLiteStore):
+    """
+    Reply messages of completed requests by request key.
+
+    Entries expire `ttl` seconds after they were recorded and no more
+    than `max_entries` are kept; the oldest are dropped first.
+    """
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS results ('
+        ' key TEXT PRIMARY KEY,'
+        ' recorded REAL NOT NULL,'
+        ' result TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS results_recorded ON results (recorded)',
+    ]
+
+    def __init__(self, path, ttl=86400, max_entries=10000):
+        super(IdempotencyStore, self).__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, key):
+        """Return the result recorded for `key`, or None"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT result FROM results WHERE key = ? AND recorded > ?',
+                (key, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def record(self, key, result):
+        """Remember `result` as the outcome of the request `key`"""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                (key, now, json.dumps(result)))
+            self._db.execute('DELETE FROM results WHERE recorded <= ?',
+                             (now - self.ttl, ))
+            self._db.execute(
+                'DELETE FROM results WHERE key IN ('
+                ' SELECT key FROM results ORDER BY recorded DESC'
+                ' LIMIT -1 OFFSET ?)', (self.max_entries, ))
+            self._db.commit()
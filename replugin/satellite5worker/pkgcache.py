@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Local cache of channel contents.
+"""
+
+import array
+import time
+import xmlrpclib
+
+from replugin.satellite5worker.store import SQLiteStore
+
+
+#: sqlite refuses statements with more host parameters than this
+QUERY_CHUNK = 500
+
+
+def nevra(package):
+    """Format a package struct from the Satellite API as a NEVRA string"""
+    epoch = package.get('epoch', '')
+    if isinstance(epoch, basestring):
+        epoch = epoch.strip()
+    if epoch:
+        evr = "%s:%s-%s" % (epoch, package['version'], package['release'])
+    else:
+        evr = "%s-%s" % (package['version'], package['release'])
+    return "%s-%s.%s" % (package['name'], evr, package.get('arch_label', ''))
+
+
+def _modified(package):
+    """Return the sortable last modified stamp of a package struct, if any"""
+    stamp = package.get('last_modified_date')
+    if isinstance(stamp, xmlrpclib.DateTime):
+        return stamp.value
+    return None
+
+
+class ChannelPackageCache(SQLiteStore):
+    """
+    Package IDs and NEVRAs per channel label.
+
+    A channel is fetched in full the first time it is used and every
+    `max_age` seconds after that. In between, lookups are answered
+    from the cache alone for `refresh_interval` seconds after the last
+    refresh; the worker's own promotions and rollbacks are applied to
+    it as they happen. After that only packages modified since the
+    newest package already cached are asked for. Those requests cannot
+    see packages removed from the channel, so the number of packages
+    cached is then checked against the count channel.listAllChannels
+    reports and the channel is fetched in full again when they differ.
+    Changes made outside the worker therefore show up within
+    `refresh_interval` seconds, or within `max_age` seconds for
+    removals matched by an equal number of additions. At most
+    `max_channels` channels are kept; the least recently used ones are
+    dropped as a whole.
+
+    The cache is kept in memory, and lost when the worker stops,
+    unless `path` names a file to keep it in.
+    """
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS channels ('
+        ' label TEXT PRIMARY KEY,'
+        ' full_refresh REAL NOT NULL,'
+        ' refreshed REAL NOT NULL,'
+        ' last_modified TEXT,'
+        ' accessed REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS packages ('
+        ' channel TEXT NOT NULL,'
+        ' id INTEGER NOT NULL,'
+        ' nevra TEXT NOT NULL,'
+        ' PRIMARY KEY (channel, id))',
+    ]
+
+    def __init__(self, path=':memory:', max_channels=20, max_age=3600,
+                 refresh_interval=300):
+        super(ChannelPackageCache, self).__init__(path)
+        self.max_channels = max_channels
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+
+    def refresh(self, client, key, label, full=False):
+        """Bring the cached contents of channel `label` up to date
+
+Returns the number of package records fetched from the Satellite."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT full_refresh, refreshed, last_modified FROM channels '
+                'WHERE label = ?', (label, )).fetchone()
+
+        if row is None or now - row[0] >= self.max_age:
+            full = True
+        elif not full and now - row[1] < self.refresh_interval:
+            return 0
+
+        if full or row[2] is None:
+            packages = client.channel.software.listAllPackages(key, label)
+            newest = None
+        else:
+            packages = client.channel.software.listAllPackages(
+                key, label, xmlrpclib.DateTime(str(row[2])))
+            newest = row[2]
+
+        records = []
+        for package in packages:
+            records.append((label, package['id'], nevra(package)))
+            newest = max(newest, _modified(package))
+
+        with self._lock:
+            if full:
+                self._db.execute('DELETE FROM packages WHERE channel = ?',
+                                 (label, ))
+                full_refresh = now
+            else:
+                full_refresh = row[0]
+            self._db.executemany(
+                'INSERT OR REPLACE INTO packages VALUES (?, ?, ?)', records)
+            self._db.execute(
+                'INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?)',
+                (label, full_refresh, now, newest, now))
+            self._evict()
+            self._db.commit()
+
+        if not full:
+            expected = self._server_count(client, key, label)
+            if expected is not None and expected != self._count(label):
+                return self.refresh(client, key, label, full=True)
+        return len(records)
+
+    def package_ids(self, client, key, label):
+        """Return a sorted array of the package IDs in channel `label`"""
+        self.refresh(client, key, label)
+        with self._lock:
+            self._db.execute('UPDATE channels SET accessed = ? WHERE label = ?',
+                             (time.time(), label))
+            self._db.commit()
+            ids = array.array('l', (r[0] for r in self._db.execute(
+                'SELECT id FROM packages WHERE channel = ? ORDER BY id',
+                (label, ))))
+        return ids
+
+    def nevras(self, label, ids):
+        """Map each of `ids` cached for channel `label` to its NEVRA"""
+        ids = list(ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), QUERY_CHUNK):
+                chunk = ids[start:start + QUERY_CHUNK]
+                found.update(self._db.execute(
+                    'SELECT id, nevra FROM packages WHERE channel = ? '
+                    'AND id IN (%s)' % ','.join('?' * len(chunk)),
+                    [label] + chunk))
+        return found
+
+    def add_packages(self, label, packages):
+        """Record `packages` (Satellite package structs) as now in `label`
+
+Does nothing if the channel is not cached."""
+        with self._lock:
+            if not self._cached(label):
+                return
+            self._db.executemany(
+                'INSERT OR REPLACE INTO packages VALUES (?, ?, ?)',
+                [(label, p['id'], nevra(p)) for p in packages])
+            self._db.commit()
+
+    def remove_packages(self, label, ids):
+        """Forget package `ids` in channel `label`"""
+        with self._lock:
+            self._db.executemany(
+                'DELETE FROM packages WHERE channel = ? AND id = ?',
+                [(label, i) for i in ids])
+            self._db.commit()
+
+    def invalidate(self, label):
+        """Drop everything cached for channel `label`"""
+        with self._lock:
+            self._drop(label)
+            self._db.commit()
+
+    def channels(self):
+        """Return the cached channel labels, most recently used first"""
+        with self._lock:
+            return [r[0] for r in self._db.execute(
+                'SELECT label FROM channels ORDER BY accessed DESC')]
+
+    def _count(self, label):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM packages WHERE channel = ?',
+                (label, )).fetchone()[0]
+
+    def _server_count(self, client, key, label):
+        """Return how many packages the Satellite has in `label`, or None
+if it does not say"""
+        for channel in client.channel.listAllChannels(key):
+            if channel.get('label') == label:
+                return channel.get('packages')
+        return None
+
+    def _cached(self, label):
+        return self._db.execute('SELECT 1 FROM channels WHERE label = ?',
+                                (label, )).fetchone() is not None
+
+    def _drop(self, label):
+        self._db.execute('DELETE FROM packages WHERE channel = ?', (label, ))
+        self._db.execute('DELETE FROM channels WHERE label = ?', (label, ))
+
+    def _evict(self):
+        """Drop the least recently used channels beyond `max_channels`"""
+        stale = self._db.execute(
+            'SELECT label FROM channels ORDER BY accessed DESC '
+            'LIMIT -1 OFFSET ?', (self.max_channels, )).fetchall()
+        for (label, ) in stale:
+            self._drop(label)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Waiting for Satellite to regenerate channel repodata.
+"""
+
+import threading
+import time
+
+
+class RepodataTimeout(Exception):
+    """
+    Raised when repodata was not rebuilt before the deadline.
+    """
+    pass
+
+
+class _ChannelState(object):
+    """
+    Polling state shared by everyone waiting on one channel.
+    """
+
+    def __init__(self, lock):
+        self.cond = threading.Condition(lock)
+        self.waiters = 0
+        #: bumped each time someone starts waiting
+        self.generation = 0
+        #: last build stamp seen and the generation its poll started in
+        self.latest = None
+        self.latest_generation = -1
+        self.polling = False
+        self.delay = None
+
+
+class RepodataWatcher(object):
+    """
+    Waits for the last build stamp of a channel to change.
+
+    Only one caller polls a given channel at a time, sleeping with
+    exponential backoff between polls. Everyone else waiting on the same
+    channel uses its results. A poll only satisfies callers that started
+    waiting before the poll was made, so a build that finished before
+    someone's merge is never taken as the build including it.
+    """
+
+    def __init__(self, initial_delay=1.0, max_delay=30.0):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def wait(self, channel, baseline, fetch, timeout):
+        """Block until `fetch()` returns something other than `baseline`
+
+`channel` identifies who shares polls. Returns the number of seconds
+waited, or raises RepodataTimeout after `timeout` seconds."""
+        start = time.time()
+        deadline = start + timeout
+        with self._lock:
+            state = self._channels.get(channel)
+            if state is None:
+                state = self._channels[channel] = _ChannelState(self._lock)
+            state.waiters += 1
+            state.generation += 1
+            generation = state.generation
+            state.delay = self.initial_delay
+
+        try:
+            while True:
+                with self._lock:
+                    if (state.latest_generation >= generation and
+                            state.latest != baseline):
+                        return time.time() - start
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RepodataTimeout(
+                            "Repodata was not rebuilt within %s seconds" %
+                            timeout)
+                    if state.polling:
+                        state.cond.wait(remaining)
+                        continue
+                    state.polling = True
+                    delay = state.delay
+                    state.delay = min(delay * 2, self.max_delay)
+
+                try:
+                    time.sleep(min(delay, remaining))
+                    with self._lock:
+                        poll_generation = state.generation
+                    value = fetch()
+                    with self._lock:
+                        state.latest = value
+                        state.latest_generation = poll_generation
+                finally:
+                    with self._lock:
+                        state.polling = False
+                        state.cond.notify_all()
+        finally:
+            with self._lock:
+                state.waiters -= 1
+                if not state.waiters:
+                    del self._channels[channel]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Ordering of queued requests by priority.
+"""
+
+import itertools
+import time
+
+
+class PriorityScheduler(object):
+    """
+    Queue of requests taken out highest priority first.
+
+    A request gains one priority level for every `aging_interval`
+    seconds it has waited, so low priority work is not starved. Between
+    requests of the same effective priority, the group (pipeline) served
+    least recently goes first, then the request queued first.
+
+    Not thread safe; the caller serializes access.
+    """
+
+    def __init__(self, aging_interval=60):
+        self.aging_interval = aging_interval
+        self._pending = []
+        self._sequence = itertools.count()
+        self._served = itertools.count(1)
+        self._last_served = {}
+        #: priority -> [requests, total seconds waited, longest wait]
+        self._waits = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, item, priority=0, group=None):
+        """Queue `item` at `priority` on behalf of `group`"""
+        self._pending.append(
+            (time.time(), next(self._sequence), priority, group, item))
+
+    def pop(self):
+        """Take out the request to run next
+
+Returns the item, its priority and the seconds it waited."""
+        now = time.time()
+
+        def rank(entry):
+            (queued, sequence, priority, group, item) = entry
+            aged = priority + int((now - queued) // self.aging_interval)
+            return (-aged, self._last_served.get(group, 0), sequence)
+
+        entry = min(self._pending, key=rank)
+        self._pending.remove(entry)
+        (queued, sequence, priority, group, item) = entry
+        self._last_served[group] = next(self._served)
+        if not any(e[3] == group for e in self._pending):
+            del self._last_served[group]
+
+        waited = now - queued
+        stats = self._waits.setdefault(priority, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        return (item, priority, waited)
+
+    def wait_stats(self, priority):
+        """Return the number of requests taken out at `priority`, their
+average and their longest wait in seconds"""
+        (count, total, longest) = self._waits.get(priority, [0, 0.0, 0.0])
+        return (count, total / count if count else 0.0, longest)
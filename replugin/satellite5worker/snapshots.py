@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Record of the packages each promotion added, for rolling it back.
+"""
+
+import array
+import sqlite3
+import time
+import zlib
+
+from replugin.satellite5worker.store import SQLiteStore
+
+
+class PromotionSnapshotStore(SQLiteStore):
+    """
+    Package IDs added by a promotion, keyed by correlation id, the
+    Satellite server the promotion ran on and the source and destination
+    channels, as one deployment may promote several channel pairs under
+    the same correlation id.
+
+    IDs are kept as a compressed array of integers. `removed` counts
+    how many of them, from the start of the array, a rollback has
+    already taken back out, so an interrupted rollback can pick up
+    where it stopped. The IDs still to be removed are kept sorted.
+    """
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS snapshots ('
+        ' corr_id TEXT NOT NULL,'
+        ' server TEXT NOT NULL,'
+        ' source TEXT NOT NULL,'
+        ' destination TEXT NOT NULL,'
+        ' created REAL NOT NULL,'
+        ' ids BLOB NOT NULL,'
+        ' removed INTEGER NOT NULL DEFAULT 0,'
+        ' PRIMARY KEY (corr_id, server, source, destination))',
+    ]
+
+    def record(self, corr_id, server, source, destination, ids):
+        """Remember that promoting `source` into `destination` added `ids`
+
+A promotion run again under the same correlation id adds its IDs to
+the ones already recorded, so the snapshot keeps covering everything
+the promotion added."""
+        with self._lock:
+            existing = self.get(corr_id, server, source, destination)
+            if existing is None:
+                self._db.execute(
+                    'INSERT INTO snapshots '
+                    '(corr_id, server, source, destination, created, ids) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (corr_id, server, source, destination, time.time(),
+                     self._pack(sorted(set(ids)))))
+            else:
+                removed = existing['removed']
+                done = existing['ids'][:removed]
+                pending = set(existing['ids'][removed:])
+                if pending.issuperset(ids):
+                    # Nothing new was added
+                    return
+                done.extend(sorted(pending.union(ids)))
+                self._db.execute(
+                    'UPDATE snapshots SET ids = ? WHERE corr_id = ? AND '
+                    'server = ? AND source = ? AND destination = ?',
+                    (self._pack(done), corr_id, server, source, destination))
+            self._db.commit()
+
+    def get(self, corr_id, server, source, destination):
+        """Return the snapshot of a promotion as a dict, or None"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT source, destination, created, ids, removed '
+                'FROM snapshots WHERE corr_id = ? AND server = ? AND '
+                'source = ? AND destination = ?',
+                (corr_id, server, source, destination)).fetchone()
+        if row is None:
+            return None
+        return self._unpack_row(row)
+
+    def find(self, corr_id, server):
+        """Return the snapshots of every channel pair promoted under
+`corr_id` on `server`, most recent promotion first"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT source, destination, created, ids, removed '
+                'FROM snapshots WHERE corr_id = ? AND server = ? '
+                'ORDER BY created DESC', (corr_id, server)).fetchall()
+        return [self._unpack_row(row) for row in rows]
+
+    def _unpack_row(self, row):
+        ids = array.array('l')
+        ids.fromstring(zlib.decompress(str(row[3])))
+        return {
+            'source': row[0],
+            'destination': row[1],
+            'created': row[2],
+            'ids': ids,
+            'removed': row[4],
+        }
+
+    def _pack(self, ids):
+        return sqlite3.Binary(zlib.compress(array.array('l', ids).tostring()))
+
+    def mark_removed(self, corr_id, server, source, destination, removed):
+        """Record that the first `removed` IDs have been rolled back"""
+        with self._lock:
+            self._db.execute(
+                'UPDATE snapshots SET removed = ? WHERE corr_id = ? AND '
+                'server = ? AND source = ? AND destination = ?',
+                (removed, corr_id, server, source, destination))
+            self._db.commit()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SQLite backed on-disk storage shared by the Satellite 5 worker.
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore(object):
+    """
+    Base class for the small local databases the worker keeps.
+
+    Subclasses list the statements needed to create their tables in
+    `schema`. A path of ':memory:' keeps the store in memory only.
+    """
+
+    #: statements run every time the store is opened
+    schema = []
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # The worker may use a store from more than one thread, so
+        # share a single connection and serialize access to it.
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            for statement in self.schema:
+                self._db.execute(statement)
+            self._db.commit()
+
+    def close(self):
+        """Close the underlying database connection"""
+        with self._lock:
+            self._db.close()
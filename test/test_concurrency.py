@@ -0,0 +1,53 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for running tasks concurrently.
+"""
+
+import threading
+import time
+
+from . import TestCase
+
+from replugin.satellite5worker.concurrency import run_concurrently
+
+
+class TestRunConcurrently(TestCase):
+    def test_results_in_order(self):
+        """Results and errors are returned in the order of the tasks"""
+        error = ValueError("nope")
+
+        def fail():
+            raise error
+
+        results = run_concurrently([lambda: 1, fail, lambda: 3])
+        self.assertEqual(results, [(1, None), (None, error), (3, None)])
+
+    def test_limit(self):
+        """No more than `limit` tasks run at the same time"""
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def task():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        run_concurrently([task] * 8, limit=3)
+        self.assertTrue(1 < peak[0] <= 3)
@@ -0,0 +1,129 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the concurrent engine.
+"""
+
+import threading
+
+import mock
+
+from . import TestCase
+
+from replugin.satellite5worker.engine import ConcurrentEngine
+
+
+class TestConcurrentEngine(TestCase):
+    def setUp(self):
+        """Set up an engine on a mocked connection"""
+        self.connection = mock.MagicMock()
+        self.logger = mock.MagicMock()
+        self.engine = ConcurrentEngine(self.connection, self.logger,
+                                       max_inflight=3)
+
+    def test_drain_timer(self):
+        """The engine checks for bus calls from the ioloop"""
+        self.connection.add_timeout.assert_called_once_with(
+            0.05, self.engine._drain)
+
+    def test_requests_run_concurrently(self):
+        """Requests run side by side, up to max_inflight of them"""
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def request(queue_wait):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            started.release()
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+        for i in range(5):
+            self.engine.submit(request)
+        for i in range(3):
+            started.acquire()
+        self.assertEqual(peak[0], 3)
+        release.set()
+        for i in range(2):
+            started.acquire()
+        self.assertEqual(self.engine._runners, 3)
+
+    def test_bus_calls_made_on_loop_thread(self):
+        """Calls from runner threads wait for the ioloop to drain them"""
+        send = mock.Mock()
+        done = threading.Event()
+
+        def request(queue_wait):
+            self.engine.call_in_loop(send, 'me', corr_id='123')
+            done.set()
+
+        self.engine.submit(request)
+        done.wait(5)
+        self.assertFalse(send.called)
+
+        self.engine._drain()
+        send.assert_called_once_with('me', corr_id='123')
+        self.assertEqual(self.connection.add_timeout.call_count, 2)
+
+        # On the loop thread the call happens right away
+        self.engine.call_in_loop(send, 'you')
+        send.assert_called_with('you')
+
+    def test_errors_are_logged(self):
+        """A failing request does not take its runner down"""
+        done = threading.Event()
+
+        def fail(queue_wait):
+            raise ValueError("boom")
+
+        self.engine.submit(fail)
+        self.engine.submit(lambda queue_wait: done.set())
+        done.wait(5)
+        self.assertTrue(done.is_set())
+        self.logger.error.assert_called_once_with(
+            "Unhandled error in request: boom")
+
+    def test_requests_run_by_priority(self):
+        """Queued requests run highest priority first and report their wait"""
+        engine = ConcurrentEngine(self.connection, self.logger, max_inflight=1)
+        started = threading.Event()
+        release = threading.Event()
+        finished = threading.Event()
+        ran = []
+
+        def request(name, queue_wait):
+            if name == 'first':
+                started.set()
+                release.wait(5)
+            ran.append((name, queue_wait >= 0))
+            if len(ran) == 4:
+                finished.set()
+
+        engine.submit(request, ('first', ))
+        started.wait(5)
+        engine.submit(request, ('low', ), -1, 'dev')
+        engine.submit(request, ('normal', ), 0, 'dev')
+        engine.submit(request, ('urgent', ), 10, 'prod')
+        release.set()
+        finished.wait(5)
+
+        self.assertEqual(ran, [('first', True), ('urgent', True),
+                               ('normal', True), ('low', True)])
+        self.assertEqual(engine.wait_stats(10)[0], 1)
@@ -0,0 +1,62 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the idempotency store.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.satellite5worker import idempotency
+
+
+class TestIdempotencyStore(TestCase):
+    def setUp(self):
+        """Set up an in-memory store"""
+        self.store = idempotency.IdempotencyStore(':memory:', ttl=60,
+                                                  max_entries=2)
+
+    def tearDown(self):
+        """
+        After every test.
+        """
+        TestCase.tearDown(self)
+        self.store.close()
+
+    def test_record_and_get(self):
+        """Recorded results are returned for the same key only"""
+        result = {'status': 'completed', 'data': {'count': 3}}
+        self.store.record('123:src:dst', result)
+        self.assertEqual(self.store.get('123:src:dst'), result)
+        self.assertIsNone(self.store.get('123:src:other'))
+
+    @mock.patch('replugin.satellite5worker.idempotency.time.time')
+    def test_results_expire(self, now):
+        """Results older than the TTL are ignored"""
+        now.return_value = 1000.0
+        self.store.record('123:src:dst', {'status': 'completed'})
+        now.return_value = 1061.0
+        self.assertIsNone(self.store.get('123:src:dst'))
+
+    @mock.patch('replugin.satellite5worker.idempotency.time.time')
+    def test_size_is_bounded(self, now):
+        """Only the newest max_entries results are kept"""
+        for i in range(3):
+            now.return_value = 1000.0 + i
+            self.store.record(str(i), {'status': 'completed'})
+        self.assertIsNone(self.store.get('0'))
+        self.assertIsNotNone(self.store.get('1'))
+        self.assertIsNotNone(self.store.get('2'))
@@ -0,0 +1,161 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the channel package cache.
+"""
+
+import xmlrpclib
+import mock
+
+from . import TestCase
+
+from replugin.satellite5worker import pkgcache
+
+
+def package(pkg_id, name='pkg', stamp='20141020T10:00:00'):
+    """Build a package struct like listAllPackages returns"""
+    return {
+        'id': pkg_id,
+        'name': name,
+        'epoch': ' ',
+        'version': '1.0',
+        'release': '1',
+        'arch_label': 'noarch',
+        'last_modified_date': xmlrpclib.DateTime(stamp),
+    }
+
+
+class TestChannelPackageCache(TestCase):
+    def setUp(self):
+        """Set up a client with a mocked listAllPackages"""
+        self.key = "sessionKeyString"
+        self.client = mock.MagicMock()
+        self.listAllPackages = self.client.channel.software.listAllPackages
+        self.cache = pkgcache.ChannelPackageCache(refresh_interval=0)
+
+    def tearDown(self):
+        """
+        After every test.
+        """
+        TestCase.tearDown(self)
+        self.cache.close()
+
+    def test_nevra(self):
+        """Package structs are formatted as NEVRA strings"""
+        self.assertEqual(pkgcache.nevra(package(1)), 'pkg-1.0-1.noarch')
+        with_epoch = package(1)
+        with_epoch['epoch'] = '2'
+        self.assertEqual(pkgcache.nevra(with_epoch), 'pkg-2:1.0-1.noarch')
+
+    def test_package_ids_first_use_fetches_everything(self):
+        """The first lookup of a channel lists all of its packages"""
+        self.listAllPackages.return_value = [package(3), package(1)]
+
+        ids = self.cache.package_ids(self.client, self.key, 'chan')
+        self.assertEqual(list(ids), [1, 3])
+        self.listAllPackages.assert_called_once_with(self.key, 'chan')
+        self.assertEqual(self.cache.nevras('chan', [3]), {3: 'pkg-1.0-1.noarch'})
+
+    def test_package_ids_refreshes_incrementally(self):
+        """Later lookups only ask for packages modified since the newest one"""
+        self.listAllPackages.return_value = [
+            package(1, stamp='20141020T10:00:00'),
+            package(2, stamp='20141021T10:00:00')]
+        self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.listAllPackages.reset_mock()
+        self.listAllPackages.return_value = [package(5)]
+        ids = self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.assertEqual(list(ids), [1, 2, 5])
+        self.listAllPackages.assert_called_once_with(
+            self.key, 'chan', xmlrpclib.DateTime('20141021T10:00:00'))
+
+    def test_package_ids_answered_locally_between_refreshes(self):
+        """Within refresh_interval lookups do not ask the Satellite"""
+        cache = pkgcache.ChannelPackageCache()
+        self.listAllPackages.return_value = [package(1)]
+        cache.package_ids(self.client, self.key, 'chan')
+        self.listAllPackages.reset_mock()
+
+        self.assertEqual(list(cache.package_ids(self.client, self.key, 'chan')), [1])
+        self.assertFalse(self.listAllPackages.called)
+        self.assertFalse(self.client.channel.listAllChannels.called)
+        cache.close()
+
+    def test_package_ids_full_refresh_when_stale(self):
+        """Channels older than max_age are fetched in full again"""
+        self.cache.max_age = 0
+        self.listAllPackages.return_value = [package(1), package(2)]
+        self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.listAllPackages.return_value = [package(2)]
+        ids = self.cache.package_ids(self.client, self.key, 'chan')
+        self.assertEqual(list(ids), [2])
+        self.listAllPackages.assert_called_with(self.key, 'chan')
+
+    def test_lru_eviction(self):
+        """Only max_channels channels are kept, least recently used go first"""
+        self.cache.max_channels = 2
+        self.listAllPackages.return_value = [package(1)]
+        for label in ('a', 'b', 'c'):
+            self.cache.package_ids(self.client, self.key, label)
+
+        self.assertEqual(self.cache.channels(), ['c', 'b'])
+        self.assertEqual(self.cache.nevras('a', [1]), {})
+
+    def test_add_and_remove_packages(self):
+        """Changes made by the worker are applied to cached channels"""
+        self.cache.refresh_interval = 3600
+        self.listAllPackages.return_value = [package(1)]
+        self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.cache.add_packages('chan', [package(7)])
+        self.cache.remove_packages('chan', [1])
+        self.cache.add_packages('uncached', [package(7)])
+
+        ids = self.cache.package_ids(self.client, self.key, 'chan')
+        self.assertEqual(list(ids), [7])
+        self.assertEqual(self.cache.channels(), ['chan'])
+        self.assertEqual(self.listAllPackages.call_count, 1)
+
+    def test_removals_force_full_refresh(self):
+        """A package count that does not match the Satellite's means
+packages were removed, so the channel is fetched in full again"""
+        self.listAllPackages.return_value = [package(1), package(2)]
+        self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.client.channel.listAllChannels.return_value = [
+            {'label': 'other', 'packages': 9},
+            {'label': 'chan', 'packages': 1}]
+        self.listAllPackages.side_effect = [[], [package(2)]]
+        ids = self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.assertEqual(list(ids), [2])
+        self.assertEqual(self.listAllPackages.call_args_list[-1],
+                         mock.call(self.key, 'chan'))
+
+    def test_matching_count_keeps_incremental_refresh(self):
+        """No full refresh happens while the counts agree"""
+        self.listAllPackages.return_value = [package(1)]
+        self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.client.channel.listAllChannels.return_value = [
+            {'label': 'chan', 'packages': 2}]
+        self.listAllPackages.return_value = [package(2)]
+        ids = self.cache.package_ids(self.client, self.key, 'chan')
+
+        self.assertEqual(list(ids), [1, 2])
+        self.assertEqual(self.listAllPackages.call_count, 2)
@@ -0,0 +1,78 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for waiting on repodata.
+"""
+
+import threading
+
+import mock
+
+from . import TestCase
+
+from replugin.satellite5worker import repodata
+
+
+class TestRepodataWatcher(TestCase):
+    def setUp(self):
+        """Set up a watcher which barely sleeps"""
+        self.watcher = repodata.RepodataWatcher(initial_delay=0.001,
+                                                max_delay=0.004)
+
+    def test_wait_until_changed(self):
+        """Polling stops once the build stamp changes"""
+        fetch = mock.Mock(side_effect=['old', 'old', 'new'])
+        waited = self.watcher.wait('chan', 'old', fetch, 5)
+        self.assertEqual(fetch.call_count, 3)
+        self.assertTrue(waited >= 0)
+
+    @mock.patch('replugin.satellite5worker.repodata.time.sleep')
+    def test_exponential_backoff(self, sleep):
+        """Sleeps between polls double up to the maximum"""
+        fetch = mock.Mock(side_effect=['old'] * 4 + ['new'])
+        self.watcher.wait('chan', 'old', fetch, 5)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                         [0.001, 0.002, 0.004, 0.004, 0.004])
+
+    def test_timeout(self):
+        """Waiting gives up after the timeout"""
+        fetch = mock.Mock(return_value='old')
+        with self.assertRaises(repodata.RepodataTimeout):
+            self.watcher.wait('chan', 'old', fetch, 0.01)
+
+    def test_concurrent_waiters_share_polls(self):
+        """Waiters on the same channel do not poll it separately"""
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'new'
+
+        results = []
+
+        def waiter():
+            results.append(self.watcher.wait('chan', 'old', fetch, 5))
+
+        threads = [threading.Thread(target=waiter) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 5)
+        self.assertTrue(len(calls) <= 2)
@@ -16,6 +16,9 @@
 Unittests.
 """
 
+import socket
+import threading
+import time
 import xmlrpclib
 import mock
 
@@ -286,6 +289,18 @@ class TestSat5Worker(TestCase):
             with self.assertRaises(satellite5worker.Satellite5WorkerError):
                 (client, key) = worker.open_client(self.config_auth_bad)
 
+            # Transport errors are reported the same way
+            client.auth.login.side_effect = [
+                socket.error(111, "Connection refused"),
+                xmlrpclib.ProtocolError(self.config_good['satellite_url'],
+                                        502, "Bad Gateway", {})
+            ]
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                (client, key) = worker.open_client(self.config_good)
+
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                (client, key) = worker.open_client(self.config_good)
+
     def test_verify_Promote_channels_good(self):
         """We're able to find the source and destination channels"""
         key = "sessionKeyString"
@@ -429,6 +444,33 @@ class TestSat5Worker(TestCase):
                                                          'sourcechannel', 'destchannel')
                 mergePackages.assert_called_once_with('sourcechannel', 'destchannel')
 
+    def test_get_channel_package_ids(self):
+        """Channel contents come from the package cache"""
+        key = "sessionKeyString"
+        client = mock.MagicMock()
+        listAllPackages = client.channel.software.listAllPackages
+        listAllPackages.return_value = [
+            {'id': 2, 'name': 'pkg', 'epoch': '', 'version': '1',
+             'release': '1', 'arch_label': 'noarch'}]
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            ids = worker.get_channel_package_ids(client, key, 'sourcechannel')
+            self.assertEqual(list(ids), [2])
+
+            listAllPackages.side_effect = xmlrpclib.Fault(1234, 'No such channel')
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                worker.get_channel_package_ids(client, key, 'missingchannel')
+
     def test_close_client_good(self):
         """We can successfully close the client connection"""
         session_string = "sessionKeyString"
@@ -562,3 +604,857 @@ class TestSat5Worker(TestCase):
             }
             worker.process(self.channel, self.basic_deliver, self.properties,
                            body, output)
+
+    def test_promote_diff(self):
+        """We can list what a promotion would add without changing anything"""
+        key = "sessionKeyString"
+        client = mock.MagicMock()
+
+        def packages(key, label):
+            ids = {'sourcechannel': [1, 2, 3, 4], 'destchannel': [2, 4]}[label]
+            return [{'id': i, 'name': 'pkg%s' % i, 'epoch': '', 'version': '1',
+                     'release': '1', 'arch_label': 'noarch'} for i in ids]
+        client.channel.software.listAllPackages.side_effect = packages
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            result = worker.do_PromoteDiff(client, key,
+                                           'sourcechannel', 'destchannel', 1)
+            self.assertEqual(result, {
+                'count': 2,
+                'packages': ['pkg1-1-1.noarch'],
+                'truncated': True})
+            self.assertFalse(client.channel.software.mergePackages.called)
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.do_PromoteDiff')
+    def test_process_promote_diff(self, diff, client):
+        """PromoteDiff replies with the difference in the result data"""
+        diff.return_value = {'count': 0, 'packages': [], 'truncated': False}
+        client.return_value = ("client", "key")
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.verify_Promote_channels'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.do_Promote_channel_merge'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.close_client')) as (
+                    _, _, send, _, merge, _):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/satellite5.json')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            output = mock.Mock()
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'PromoteDiff',
+                    'diff_limit': 10
+                },
+                'dynamic': {
+                    'promote_from_label': 'sourcechannel',
+                    'promote_to_label': 'destchannel'
+                }
+            }
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, output)
+
+            diff.assert_called_once_with("client", "key",
+                                         'sourcechannel', 'destchannel', 10)
+            self.assertFalse(merge.called)
+            send.assert_called_with(
+                'me', '123',
+                {'status': 'completed', 'data': diff.return_value},
+                exchange='')
+
+    def test_rollback_promotion(self):
+        """Packages added by a promotion are removed again in batches"""
+        key = "sessionKeyString"
+        client = mock.MagicMock()
+        client.channel.software.mergePackages.return_value = [
+            {'id': i, 'name': 'pkg', 'epoch': '', 'version': '1',
+             'release': '1', 'arch_label': 'noarch'} for i in range(5)]
+        removePackages = client.channel.software.removePackages
+        removePackages.side_effect = [
+            1, xmlrpclib.Fault(1234, 'Timed out'), 1, 1]
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = dict(self.config_good,
+                                  snapshots={'path': ':memory:'})
+
+            worker.do_Promote_channel_merge(client, key, 'sourcechannel',
+                                            'destchannel', corr_id='123')
+
+            cache = worker.get_package_cache()
+            cache.package_ids(client, key, 'destchannel')
+            self.assertEqual(cache.channels(), ['destchannel'])
+
+            output = mock.Mock()
+            # The second batch fails ...
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                worker.do_RollbackPromotion(client, key, '123', 2, output)
+            # ... which leaves the destination's cached contents uncertain
+            self.assertEqual(cache.channels(), [])
+
+            # ... and running the rollback again picks up from there
+            result = worker.do_RollbackPromotion(client, key, '123', 2, output)
+            self.assertEqual(result, (3, ['destchannel']))
+            self.assertEqual(removePackages.call_args_list, [
+                mock.call(key, 'destchannel', [0, 1]),
+                mock.call(key, 'destchannel', [2, 3]),
+                mock.call(key, 'destchannel', [2, 3]),
+                mock.call(key, 'destchannel', [4])])
+
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                worker.do_RollbackPromotion(client, key, '456', 2, output)
+
+    def test_rollback_promotion_of_several_channel_pairs(self):
+        """Each channel pair promoted under one correlation id is rolled
+back in its own destination"""
+        key = "sessionKeyString"
+        client = mock.MagicMock()
+        client.channel.software.mergePackages.side_effect = [
+            [{'id': 1, 'name': 'a', 'epoch': '', 'version': '1',
+              'release': '1', 'arch_label': 'noarch'}],
+            [{'id': 99, 'name': 'c', 'epoch': '', 'version': '1',
+              'release': '1', 'arch_label': 'noarch'}]]
+        removePackages = client.channel.software.removePackages
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = dict(self.config_good,
+                                  snapshots={'path': ':memory:'})
+
+            worker.do_Promote_channel_merge(client, key, 'A', 'B', corr_id='123')
+            worker.do_Promote_channel_merge(client, key, 'C', 'D', corr_id='123')
+
+            (result, destinations) = worker.do_RollbackPromotion(
+                client, key, '123', 10, mock.Mock())
+            self.assertEqual(result, 2)
+            self.assertEqual(sorted(destinations), ['B', 'D'])
+            self.assertEqual(
+                sorted(removePackages.call_args_list),
+                sorted([mock.call(key, 'B', [1]), mock.call(key, 'D', [99])]))
+
+    def test_rollback_promotion_without_snapshots(self):
+        """Rolling back needs snapshots to be enabled"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = self.config_good
+
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                worker.do_RollbackPromotion(mock.MagicMock(), 'key', '123', 2,
+                                            mock.Mock())
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.do_Promote_channel_merge')
+    def test_process_redelivered(self, merge, client):
+        """A redelivered promotion gets the recorded result without re-running"""
+        merge.return_value = 4
+        client.return_value = ("client", "key")
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.verify_Promote_channels'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.close_client')) as (
+                    _, _, send, _, _):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = dict(self.config_good,
+                                  idempotency={'path': ':memory:'})
+
+            output = mock.Mock()
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'Promote'
+                },
+                'dynamic': {
+                    'promote_from_label': 'sourcechannel',
+                    'promote_to_label': 'destchannel'
+                }
+            }
+            completed = mock.call(
+                'me', '123', {'status': 'completed', 'data': {'count': 4}},
+                exchange='')
+
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, output)
+            self.assertEqual(send.call_args, completed)
+
+            send.reset_mock()
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, output)
+            self.assertEqual(send.call_args_list, [completed])
+            self.assertEqual(merge.call_count, 1)
+            self.assertEqual(client.call_count, 1)
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    def test_process_bad_optional_config(self, client):
+        """Broken optional config sections fail the request with a reply"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')) as (
+                    _, _, send):
+
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'Promote'
+                },
+                'dynamic': {
+                    'promote_from_label': 'sourcechannel',
+                    'promote_to_label': 'destchannel'
+                }
+            }
+            for section in ({'idempotency': {'ttl': 60}},
+                            {'idempotency': {'path': ':memory:', 'max_entires': 5}},
+                            {'idempotency': {'path': '/dev/null/results.db'}},
+                            {'engine': {'max_in_flight': 5}},
+                            {'engine': 'yes'}):
+                worker = satellite5worker.Satellite5Worker(
+                    MQ_CONF,
+                    logger=self.app_logger)
+                worker._on_open(self.connection)
+                worker._on_channel_open(self.channel)
+                worker._config = dict(self.config_good, **section)
+
+                send.reset_mock()
+                output = mock.Mock()
+                worker.process(self.channel, self.basic_deliver,
+                               self.properties, body, output)
+                self.assertEqual(send.call_args,
+                                 mock.call('me', '123', {'status': 'failed'},
+                                           exchange=''))
+                self.assertTrue(output.error.called)
+            self.assertFalse(client.called)
+
+            # Sections first used while running a request fail it there
+            for (section, getter) in (
+                    ({'snapshots': {}}, 'get_snapshot_store'),
+                    ({'package_cache': {'max_ages': 60}}, 'get_package_cache'),
+                    ({'package_cache': {'path': '/dev/null/cache.db'}},
+                     'get_package_cache')):
+                worker._config = dict(self.config_good, **section)
+                with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                    getattr(worker, getter)()
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.do_Promote_channel_merge')
+    def test_process_wait_for_repodata(self, merge, client):
+        """Promote can wait for the destination repodata to be rebuilt"""
+        merge.return_value = 2
+        sat = mock.MagicMock()
+        sat.channel.software.getDetails.return_value = {'id': 42}
+        sat.channel.software.getChannelLastBuildById.side_effect = [
+            '2014-10-20 10:00:00', '2014-10-20 10:00:00', '2014-10-20 10:05:00']
+        client.return_value = (sat, "key")
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.verify_Promote_channels'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.close_client'),
+                mock.patch('replugin.satellite5worker.repodata.time.sleep')) as (
+                    _, _, send, _, _, _):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/satellite5.json')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            output = mock.Mock()
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'Promote',
+                    'wait_for_repodata': True
+                },
+                'dynamic': {
+                    'promote_from_label': 'sourcechannel',
+                    'promote_to_label': 'destchannel'
+                }
+            }
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, output)
+
+            result = send.call_args[0][2]
+            self.assertEqual(result['status'], 'completed')
+            self.assertEqual(result['data']['count'], 2)
+            self.assertIn('repodata_seconds', result['data'])
+            sat.channel.software.getChannelLastBuildById.assert_called_with('key', 42)
+            self.assertEqual(
+                sat.channel.software.getChannelLastBuildById.call_count, 3)
+
+    def test_verify_satellite_config_multiple(self):
+        """A list of Satellites can be configured instead of just one"""
+        config = {
+            "queue": "satellite5",
+            "satellites": [
+                dict(self.config_good, name="primary"),
+                dict(self.config_good, satellite_url="https://replica.example.com/rpc/api")
+            ]
+        }
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            self.assertTrue(worker.verify_config(config))
+            self.assertEqual(
+                [e['name'] for e in worker.satellite_endpoints(config)],
+                ['primary', 'https://replica.example.com/rpc/api'])
+
+            config['satellites'].append(self.config_bad_url)
+            self.assertFalse(worker.verify_config(config))
+            self.assertFalse(worker.verify_config({'satellites': []}))
+
+            self.assertEqual(worker.resolve_quorum('all', 3), 3)
+            self.assertEqual(worker.resolve_quorum('majority', 3), 2)
+            self.assertEqual(worker.resolve_quorum(1, 3), 1)
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                worker.resolve_quorum(4, 3)
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.do_Promote_channel_merge')
+    def test_process_fan_out(self, merge, client):
+        """Promote runs on every Satellite and honours the quorum"""
+        def merge_on(client, key, source, dest, corr_id=None, server=None):
+            if server == 'https://replica2.example.com/rpc/api':
+                raise satellite5worker.Satellite5WorkerError("Could not promote")
+            return 3
+        merge.side_effect = merge_on
+        client.return_value = ("client", "key")
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.verify_Promote_channels'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.close_client')) as (
+                    _, _, send, _, _):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = {
+                'satellites': [
+                    dict(self.config_good, name='primary'),
+                    dict(self.config_good, name='replica1',
+                         satellite_url='https://replica1.example.com/rpc/api'),
+                    dict(self.config_good, name='replica2',
+                         satellite_url='https://replica2.example.com/rpc/api')
+                ],
+                'satellite_quorum': 'majority'
+            }
+
+            output = mock.Mock()
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'Promote'
+                },
+                'dynamic': {
+                    'promote_from_label': 'sourcechannel',
+                    'promote_to_label': 'destchannel'
+                }
+            }
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, output)
+
+            self.assertEqual(client.call_count, 3)
+            result = send.call_args[0][2]
+            self.assertEqual(result['status'], 'completed')
+            self.assertEqual(result['data']['count'], 6)
+            self.assertEqual(result['data']['failed'], ['replica2'])
+            self.assertEqual(result['data']['servers']['primary'], {'count': 3})
+            self.assertIn('error', result['data']['servers']['replica2'])
+
+            body['parameters']['quorum'] = 'all'
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, output)
+            self.assertEqual(send.call_args[0][2], {'status': 'failed'})
+
+    @mock.patch('replugin.satellite5worker.xmlrpclib.Server')
+    def test_clone_channel_tree(self, xmlserver):
+        """A channel and its children are cloned, children under the new parent"""
+        key = "sessionKeyString"
+        client = mock.MagicMock()
+        software = client.channel.software
+        software.getDetails.return_value = {'label': 'rhel-2014q3',
+                                            'parent_channel_label': ''}
+        software.listChildren.return_value = [
+            {'label': 'rhel-2014q3-tools'}, {'label': 'optional'}]
+        software.clone.return_value = 100
+        client.channel.listAllChannels.side_effect = [[], [
+            {'label': 'rhel-2014q4', 'id': 100, 'packages': 50},
+            {'label': 'rhel-2014q4-tools', 'id': 101, 'packages': 5},
+            {'label': 'rhel-2014q4-optional', 'id': 101, 'packages': 7}]]
+        child_client = mock.MagicMock()
+        child_client.channel.software.clone.return_value = 101
+        xmlserver.return_value = child_client
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            endpoint = worker.satellite_endpoints(self.config_good)[0]
+
+            cloned = worker.do_CloneChannel(
+                endpoint, client, key, 'rhel-2014q3', 'rhel-2014q4', True,
+                False, 2, mock.Mock())
+
+            software.clone.assert_called_once_with(
+                key, 'rhel-2014q3',
+                {'name': 'rhel-2014q4', 'label': 'rhel-2014q4',
+                 'summary': 'Clone of rhel-2014q3'}, False)
+            child_client.channel.software.clone.assert_any_call(
+                key, 'rhel-2014q3-tools',
+                {'name': 'rhel-2014q4-tools', 'label': 'rhel-2014q4-tools',
+                 'summary': 'Clone of rhel-2014q3-tools',
+                 'parent_label': 'rhel-2014q4'}, False)
+            self.assertEqual(
+                sorted((c['label'], c['packages']) for c in cloned),
+                [('rhel-2014q4', 50), ('rhel-2014q4-optional', 7),
+                 ('rhel-2014q4-tools', 5)])
+            for channel in cloned:
+                self.assertIn('seconds', channel)
+
+            child_client.channel.software.clone.side_effect = xmlrpclib.Fault(
+                1234, 'Channel exists')
+            client.channel.listAllChannels.side_effect = [[]]
+            with self.assertRaises(satellite5worker.Satellite5WorkerError) as error:
+                worker.do_CloneChannel(
+                    endpoint, client, key, 'rhel-2014q3', 'rhel-2014q4', True,
+                    False, 2, mock.Mock())
+            # The failure says what was cloned before it
+            self.assertIn('in place: rhel-2014q4', str(error.exception))
+
+    @mock.patch('replugin.satellite5worker.xmlrpclib.Server')
+    def test_clone_channel_tree_again(self, xmlserver):
+        """Running a clone again after a failure only clones what is missing"""
+        key = "sessionKeyString"
+        client = mock.MagicMock()
+        software = client.channel.software
+        software.getDetails.return_value = {'label': 'rhel-2014q3',
+                                            'parent_channel_label': ''}
+        software.listChildren.return_value = [
+            {'label': 'rhel-2014q3-tools'}, {'label': 'optional'}]
+        existing = [{'label': 'rhel-2014q4', 'id': 100, 'packages': 50},
+                    {'label': 'rhel-2014q4-tools', 'id': 101, 'packages': 5}]
+        client.channel.listAllChannels.side_effect = [
+            existing,
+            existing + [{'label': 'rhel-2014q4-optional', 'id': 102,
+                         'packages': 7}]]
+        child_client = mock.MagicMock()
+        child_client.channel.software.clone.return_value = 102
+        xmlserver.return_value = child_client
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            endpoint = worker.satellite_endpoints(self.config_good)[0]
+
+            cloned = worker.do_CloneChannel(
+                endpoint, client, key, 'rhel-2014q3', 'rhel-2014q4', True,
+                False, 2, mock.Mock())
+
+            self.assertFalse(software.clone.called)
+            child_client.channel.software.clone.assert_called_once_with(
+                key, 'optional',
+                {'name': 'rhel-2014q4-optional', 'label': 'rhel-2014q4-optional',
+                 'summary': 'Clone of optional',
+                 'parent_label': 'rhel-2014q4'}, False)
+            self.assertEqual(
+                sorted((c['label'], c['id'], c.get('existing', False))
+                       for c in cloned),
+                [('rhel-2014q4', 100, True),
+                 ('rhel-2014q4-optional', 102, False),
+                 ('rhel-2014q4-tools', 101, True)])
+
+    @mock.patch('replugin.satellite5worker.xmlrpclib.Server')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.do_CloneChannel_clone')
+    def test_process_clone_channel_cap_across_satellites(self, do_clone, client, xmlserver):
+        """clone_concurrency caps the clones in flight on all Satellites together"""
+        sat = mock.MagicMock()
+        sat.channel.software.getDetails.return_value = {'parent_channel_label': ''}
+        sat.channel.software.listChildren.return_value = [
+            {'label': 'a'}, {'label': 'b'}]
+        sat.channel.listAllChannels.return_value = []
+        client.return_value = (sat, "key")
+
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0}
+
+        def slow_clone(client, key, source, label, parent, original_state):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+            return {'label': label, 'source': source, 'id': 1, 'seconds': 0.02}
+        do_clone.side_effect = slow_clone
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.close_client')) as (
+                    _, _, send, _):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = {'satellites': [
+                dict(self.config_good, satellite_url='https://sat%s/rpc' % i)
+                for i in range(3)]}
+
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'CloneChannel',
+                    'clone_children': True,
+                    'clone_concurrency': 2
+                },
+                'dynamic': {
+                    'clone_from_label': 'sourcechannel',
+                    'clone_to_label': 'destchannel'
+                }
+            }
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, mock.Mock())
+
+            self.assertEqual(send.call_args[0][2]['status'], 'completed')
+            self.assertEqual(send.call_args[0][2]['data']['count'], 9)
+            self.assertEqual(do_clone.call_count, 9)
+            self.assertEqual(state['most'], 2)
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.do_CloneChannel')
+    def test_process_clone_channel(self, clone, client):
+        """CloneChannel replies with the cloned channels"""
+        clone.return_value = [{'label': 'destchannel', 'source': 'sourcechannel',
+                               'id': 1, 'seconds': 0.5, 'packages': 3}]
+        client.return_value = ("client", "key")
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.close_client')) as (
+                    _, _, send, _):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/satellite5.json')
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            output = mock.Mock()
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'CloneChannel',
+                    'clone_children': True
+                },
+                'dynamic': {
+                    'clone_from_label': 'sourcechannel',
+                    'clone_to_label': 'destchannel'
+                }
+            }
+            worker.process(self.channel, self.basic_deliver, self.properties,
+                           body, output)
+
+            self.assertEqual(clone.call_args[0][2:],
+                             ("key", 'sourcechannel', 'destchannel', True,
+                              False, 4, output))
+            send.assert_called_with(
+                'me', '123',
+                {'status': 'completed',
+                 'data': {'count': 1, 'channels': clone.return_value}},
+                exchange='')
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.open_client')
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.do_Promote_channel_merge')
+    def test_process_with_engine(self, merge, client):
+        """With the engine enabled requests run off the consumer thread and
+their replies go out through the ioloop"""
+        merge.return_value = 1
+        client.return_value = ("client", "key")
+        channel = mock.MagicMock()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('reworker.worker.Worker.notify'),
+                mock.patch('reworker.worker.Worker.send'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.verify_Promote_channels'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.close_client')) as (
+                    _, notify, send, _, _):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = dict(self.config_good, engine={'max_inflight': 2})
+
+            output = mock.Mock()
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'Promote'
+                },
+                'dynamic': {
+                    'promote_from_label': 'sourcechannel',
+                    'promote_to_label': 'destchannel'
+                }
+            }
+            worker.process(channel, self.basic_deliver, self.properties,
+                           body, output)
+            # Wait for the started and completed send and notify calls
+            for i in range(500):
+                if worker._engine._outbox.qsize() == 4:
+                    break
+                time.sleep(0.01)
+
+            # Nothing reached the bus from the runner thread ...
+            self.assertFalse(send.called)
+            worker._engine._drain()
+            # ... until the ioloop drained it
+            self.assertEqual(
+                [c[0][2]['status'] for c in send.call_args_list],
+                ['started', 'completed'])
+            self.assertEqual(notify.call_count, 2)
+            data = send.call_args[0][2]['data']
+            self.assertEqual(data['priority'], 0)
+            self.assertIn('queue_wait', data)
+
+    @mock.patch('replugin.satellite5worker.Satellite5Worker.process_Promote')
+    def test_process_with_engine_unexpected_error(self, promote):
+        """Unexpected errors in a request run by the engine still get a
+failed reply"""
+        promote.side_effect = KeyError('id')
+        channel = mock.MagicMock()
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('reworker.worker.Worker.notify'),
+                mock.patch('reworker.worker.Worker.send')) as (
+                    _, notify, send):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = dict(self.config_good, engine={'max_inflight': 2})
+
+            output = mock.Mock()
+            body = {
+                'parameters': {
+                    'command': 'satellite5',
+                    'subcommand': 'Promote'
+                },
+                'dynamic': {
+                    'promote_from_label': 'sourcechannel',
+                    'promote_to_label': 'destchannel'
+                }
+            }
+            worker.process(channel, self.basic_deliver, self.properties,
+                           body, output)
+            for i in range(500):
+                if worker._engine._outbox.qsize() == 4:
+                    break
+                time.sleep(0.01)
+            worker._engine._drain()
+
+            self.assertEqual(
+                [c[0][2]['status'] for c in send.call_args_list],
+                ['started', 'failed'])
+            self.assertEqual(notify.call_args[0][2], 'failed')
+            self.assertTrue(output.error.called)
+
+    def test_request_priority(self):
+        """Priority and fairness group come from the parameters"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            self.assertEqual(
+                worker.request_priority(
+                    {'parameters': {'priority': '5', 'pipeline': 'hotfix'}}, '123'),
+                (5, 'hotfix'))
+            self.assertEqual(
+                worker.request_priority({'parameters': {}}, '123'), (0, '123'))
+            self.assertEqual(
+                worker.request_priority(
+                    {'parameters': {'priority': 'urgent'}}, '123'), (0, '123'))
+
+    def test_package_cache_only_tracks_primary(self):
+        """Merges and rollbacks on a replica leave the primary's cached
+channel contents alone"""
+        key = "sessionKeyString"
+        primary = mock.MagicMock()
+        primary.channel.software.listAllPackages.return_value = [
+            {'id': 1, 'name': 'pkg', 'epoch': '', 'version': '1',
+             'release': '1', 'arch_label': 'noarch'}]
+        replica = mock.MagicMock()
+        replica.channel.software.mergePackages.return_value = [
+            {'id': 2002, 'name': 'new', 'epoch': '', 'version': '1',
+             'release': '1', 'arch_label': 'noarch'}]
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = {
+                'satellites': [
+                    self.config_good,
+                    dict(self.config_good, satellite_url='https://r/rpc')
+                ],
+                'snapshots': {'path': ':memory:'},
+                'package_cache': {'refresh_interval': 3600}
+            }
+            cache = worker.get_package_cache()
+
+            self.assertEqual(
+                list(worker.get_channel_package_ids(primary, key, 'dst')), [1])
+
+            worker.do_Promote_channel_merge(replica, key, 'src', 'dst',
+                                            corr_id='123', server='https://r/rpc')
+            self.assertEqual(list(cache.package_ids(primary, key, 'dst')), [1])
+
+            cache.add_packages('dst', [{'id': 2002, 'name': 'clash',
+                                        'epoch': '', 'version': '1',
+                                        'release': '1', 'arch_label': 'noarch'}])
+            worker.do_RollbackPromotion(replica, key, '123', 10, mock.Mock(),
+                                        server='https://r/rpc')
+            replica.channel.software.removePackages.assert_called_once_with(
+                key, 'dst', [2002])
+            self.assertEqual(list(cache.package_ids(primary, key, 'dst')),
+                             [1, 2002])
+
+    def test_no_satellites_configured(self):
+        """An empty list of Satellites is an error, not a quiet success"""
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.notify'),
+                mock.patch('replugin.satellite5worker.Satellite5Worker.send')) as (
+                    _, _, send):
+
+            worker = satellite5worker.Satellite5Worker(
+                MQ_CONF,
+                logger=self.app_logger)
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+            worker._config = {'satellites': []}
+
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                worker.satellite_endpoints(worker._config)
+            with self.assertRaises(satellite5worker.Satellite5WorkerError):
+                worker.resolve_quorum('all', 0)
+
+            output = mock.Mock()
+            for subcommand in ('Promote', 'PromoteDiff'):
+                body = {
+                    'parameters': {
+                        'command': 'satellite5',
+                        'subcommand': subcommand
+                    },
+                    'dynamic': {
+                        'promote_from_label': 'sourcechannel',
+                        'promote_to_label': 'destchannel'
+                    }
+                }
+                worker.process(self.channel, self.basic_deliver,
+                               self.properties, body, output)
+                self.assertEqual(send.call_args[0][2], {'status': 'failed'})
@@ -0,0 +1,76 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the priority scheduler.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.satellite5worker.scheduler import PriorityScheduler
+
+
+class TestPriorityScheduler(TestCase):
+    def setUp(self):
+        """Set up a scheduler on a mocked clock"""
+        self.time = mock.patch('replugin.satellite5worker.scheduler.time.time',
+                               return_value=1000.0)
+        self.now = self.time.start()
+        self.scheduler = PriorityScheduler(aging_interval=60)
+
+    def tearDown(self):
+        """
+        After every test.
+        """
+        TestCase.tearDown(self)
+        self.time.stop()
+
+    def drain(self):
+        return [self.scheduler.pop()[0] for i in range(len(self.scheduler))]
+
+    def test_highest_priority_first(self):
+        """Urgent requests jump the queue"""
+        for i in range(3):
+            self.scheduler.put('bulk%s' % i, 0, 'dev')
+        self.scheduler.put('hotfix', 5, 'prod')
+        self.assertEqual(self.drain(), ['hotfix', 'bulk0', 'bulk1', 'bulk2'])
+
+    def test_groups_share_fairly(self):
+        """Groups at the same priority take turns"""
+        for i in range(3):
+            self.scheduler.put('dev%s' % i, 0, 'dev')
+        self.scheduler.put('qa0', 0, 'qa')
+        self.scheduler.put('qa1', 0, 'qa')
+        self.assertEqual(self.drain(), ['dev0', 'qa0', 'dev1', 'qa1', 'dev2'])
+
+    def test_aging(self):
+        """Requests gain a priority level per aging interval waited"""
+        self.scheduler.put('old', 0, 'dev')
+        self.now.return_value = 1130.0
+        self.scheduler.put('new', 1, 'prod')
+        self.assertEqual(self.drain(), ['old', 'new'])
+
+    def test_wait_stats(self):
+        """Queue waits are tracked per priority"""
+        self.scheduler.put('a', 0)
+        self.scheduler.put('b', 0)
+        self.now.return_value = 1002.0
+        (item, priority, waited) = self.scheduler.pop()
+        self.assertEqual((item, priority, waited), ('a', 0, 2.0))
+        self.now.return_value = 1004.0
+        self.scheduler.pop()
+        self.assertEqual(self.scheduler.wait_stats(0), (2, 3.0, 4.0))
+        self.assertEqual(self.scheduler.wait_stats(9), (0, 0.0, 0.0))
@@ -0,0 +1,91 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the promotion snapshot store.
+"""
+
+from . import TestCase
+
+from replugin.satellite5worker import snapshots
+
+
+class TestPromotionSnapshotStore(TestCase):
+    def setUp(self):
+        """Set up an in-memory store"""
+        self.store = snapshots.PromotionSnapshotStore(':memory:')
+
+    def tearDown(self):
+        """
+        After every test.
+        """
+        TestCase.tearDown(self)
+        self.store.close()
+
+    def test_record_and_get(self):
+        """Recorded package IDs come back sorted"""
+        self.store.record('123', 'https://sat', 'src', 'dst', [9, 3, 5])
+
+        snapshot = self.store.get('123', 'https://sat', 'src', 'dst')
+        self.assertEqual(list(snapshot['ids']), [3, 5, 9])
+        self.assertEqual(snapshot['source'], 'src')
+        self.assertEqual(snapshot['destination'], 'dst')
+        self.assertEqual(snapshot['removed'], 0)
+
+    def test_get_unknown(self):
+        """Unknown promotions have no snapshot"""
+        self.store.record('123', 'https://sat', 'src', 'dst', [1])
+        self.assertIsNone(self.store.get('456', 'https://sat', 'src', 'dst'))
+        self.assertIsNone(self.store.get('123', 'https://other', 'src', 'dst'))
+
+    def test_mark_removed(self):
+        """Rollback progress is saved with the snapshot"""
+        self.store.record('123', 'https://sat', 'src', 'dst', range(10))
+        self.store.mark_removed('123', 'https://sat', 'src', 'dst', 4)
+        self.assertEqual(self.store.get('123', 'https://sat', 'src', 'dst')['removed'], 4)
+
+    def test_record_again_merges(self):
+        """Running a promotion again does not lose what it added before"""
+        self.store.record('123', 'https://sat', 'src', 'dst', [5, 1])
+        self.store.record('123', 'https://sat', 'src', 'dst', [])
+        self.assertEqual(list(self.store.get('123', 'https://sat', 'src', 'dst')['ids']), [1, 5])
+
+        self.store.record('123', 'https://sat', 'src', 'dst', [3])
+        self.assertEqual(list(self.store.get('123', 'https://sat', 'src', 'dst')['ids']),
+                         [1, 3, 5])
+
+    def test_record_again_after_partial_rollback(self):
+        """IDs already rolled back stay counted as removed"""
+        self.store.record('123', 'https://sat', 'src', 'dst', [1, 2, 3])
+        self.store.mark_removed('123', 'https://sat', 'src', 'dst', 2)
+        self.store.record('123', 'https://sat', 'src', 'dst', [1, 4])
+
+        snapshot = self.store.get('123', 'https://sat', 'src', 'dst')
+        self.assertEqual(snapshot['removed'], 2)
+        self.assertEqual(list(snapshot['ids'][snapshot['removed']:]), [1, 3, 4])
+
+    def test_channel_pairs_kept_apart(self):
+        """Channel pairs promoted under one correlation id get a snapshot each"""
+        self.store.record('123', 'https://sat', 'A', 'B', [1])
+        self.store.record('123', 'https://sat', 'C', 'D', [99])
+
+        self.assertEqual(list(self.store.get('123', 'https://sat', 'A', 'B')['ids']),
+                         [1])
+        self.assertEqual(list(self.store.get('123', 'https://sat', 'C', 'D')['ids']),
+                         [99])
+        self.assertEqual(
+            sorted((s['destination'], list(s['ids'])) for s in
+                   self.store.find('123', 'https://sat')),
+            [('B', [1]), ('D', [99])])
+        self.assertEqual(self.store.find('123', 'https://other'), [])